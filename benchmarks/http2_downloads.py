@@ -0,0 +1,117 @@
+"""
+Compares Adownloader over HTTP/1.1 and HTTP/2 against a local HTTP/2 server
+
+Downloads go through the clients of http_manager. HTTP/1.1 runs within the default
+host limit, HTTP/2 within HTTP2_STREAMS once the server answered over HTTP/2.
+Needs the dev dependencies and the openssl cli:
+    python benchmarks/http2_downloads.py --files 200 --size 262144 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+from mediamagic.services.adownloader import Adownloader
+from mediamagic.services.httpclient import http_manager
+
+
+def make_app(size: int, latency: float):
+    body = b"\0" * size
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        await asyncio.sleep(latency)  # time to first byte of a far away CDN
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-length", str(size).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+async def run(args: argparse.Namespace, tmp: Path) -> None:
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            str(tmp / "key.pem"),
+            "-out",
+            str(tmp / "cert.pem"),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    config = Config()
+    config.bind = [f"127.0.0.1:{args.port}"]
+    config.certfile = str(tmp / "cert.pem")
+    config.keyfile = str(tmp / "key.pem")
+    config.alpn_protocols = ["h2", "http/1.1"]
+    config.loglevel = "WARNING"
+    # The shared transports verify certificates, trust the self signed one
+    os.environ["SSL_CERT_FILE"] = config.certfile
+    shutdown = asyncio.Event()
+    server = asyncio.create_task(
+        serve(make_app(args.size, args.latency), config, shutdown_trigger=shutdown.wait)
+    )
+    await asyncio.sleep(1)
+
+    urls = {f"https://localhost:{args.port}/{i}.bin" for i in range(args.files)}
+    total = args.files * args.size / 1024**2
+    try:
+        for http2 in (False, True):
+            client = http_manager.download_h2 if http2 else http_manager.download
+            downloader = Adownloader(
+                urls, client=client, http2=http2, single_flight=None
+            )
+            start = time.perf_counter()
+            dir = await downloader.download(tmp / f"http2_{http2}")
+            elapsed = time.perf_counter() - start
+            files = len(list(dir.iterdir()))
+            print(
+                f"{'HTTP/2' if http2 else 'HTTP/1.1'}: {files} files "
+                f"{total:.1f} MB in {elapsed:.2f}s ({total / elapsed:.1f} MB/s)"
+            )
+    finally:
+        await http_manager.aclose()
+        shutdown.set()
+        await server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256 * 1024)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8443)
+    args = parser.parse_args()
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        asyncio.run(run(args, tmp))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compares the VidSegmenter engines on a synthetic video
+
+Runs every engine over a suite of synthetic videos, short and long keyframe intervals
+and a few resolutions, and reports wall time, piece count and the largest piece.
+
+Needs ffmpeg/ffprobe on PATH, v2 needs the videosegmenter binary in the working directory:
+    python benchmarks/segment_engines.py --limit 10 --engines v2 v3 v4
+    python benchmarks/segment_engines.py --video 1920x1080:60:300
+"""
+
+import argparse
+import asyncio
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from mediamagic.services.videosegmenter import VidSegmenter
+
+
+def make_video(out: Path, duration: int, size: str, gop: int) -> None:
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=size={size}:rate=30",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=frequency=440",
+            "-t",
+            str(duration),
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-g",
+            str(gop),
+            "-c:a",
+            "aac",
+            str(out),
+        ],
+        check=True,
+    )
+
+
+# size:gop:duration of the synthetic videos
+SUITE = ["854x480:30:300", "1280x720:90:300", "1920x1080:250:180"]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--video", nargs="+", default=SUITE, help="size:gop:duration")
+    parser.add_argument("--limit", type=int, default=10, help="max_size in Mb")
+    parser.add_argument("--engines", nargs="+", default=["v1", "v2", "v3", "v4", "hls"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for video in args.video:
+            size, gop, duration = video.split(":")
+            source = Path(tmp) / "source.mp4"
+            make_video(source, int(duration), size, int(gop))
+            print(
+                f"{size} gop {gop} {duration}s: "
+                f"{source.stat().st_size / 1024**2:.1f} Mb, limit {args.limit} Mb"
+            )
+            for engine in args.engines:
+                media = Path(tmp) / f"{engine}.mp4"
+                shutil.copy(source, media)
+                save_dir = Path(tmp) / f"{engine}-out"
+                save_dir.mkdir()
+                start = time.perf_counter()
+                try:
+                    out = await VidSegmenter(args.limit, engine).segment(
+                        media, save_dir
+                    )
+                except Exception as e:
+                    print(f"{engine:>6}: failed {e!r}")
+                    continue
+                finally:
+                    elapsed = time.perf_counter() - start
+                sizes = [
+                    x.stat().st_size / 1024**2
+                    for x in out.rglob("*")
+                    if x.is_file() and x.suffix != ".m3u8"
+                ]
+                over = sum(x > args.limit for x in sizes)
+                print(
+                    f"{engine:>6}: {elapsed:6.2f}s {len(sizes):3} pieces "
+                    f"largest {max(sizes):.2f} Mb, {over} over the limit"
+                )
+                shutil.rmtree(save_dir)
+                media.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,6 +3,7 @@ import logging
 from disnake.ext import commands
 
 from mediamagic.constants import Client
+from mediamagic.services.httpclient import http_manager
 from mediamagic.utils.extensions import walk_extensions
 
 logger = logging.getLogger(__name__)
@@ -18,3 +19,7 @@ class MediaMagic(commands.Bot):
         for ext in walk_extensions():
             logger.info(f"{ext} extension loaded!")
             self.load_extension(ext)
+
+    async def close(self) -> None:
+        await super().close()
+        await http_manager.aclose()
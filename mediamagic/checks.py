@@ -1,11 +1,11 @@
 import logging
 
 import disnake
-import httpx
 from disnake.ext import commands
 
 from mediamagic.constants import Client
 from mediamagic.exceptions import NotPremium, NotVoted, Premium_Owner
+from mediamagic.services.httpclient import http_manager
 
 logger = logging.getLogger(__name__)
 
@@ -61,8 +61,7 @@ async def ensure_vote():
         if Client.debug_mode:
             return True
         URL = f"https://top.gg/api/bots/{inter.bot.application_id}/check"
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(URL)
+        resp = await http_manager.api.get(URL)
         resp = resp.json()
         if resp.get("voted"):
             return True
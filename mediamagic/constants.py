@@ -1,3 +1,4 @@
+import json
 import os
 
 
@@ -13,6 +14,68 @@ class Client:
     command_prefix = "!"
     nsfw_api = os.getenv("NSFW_API")
     url_group_limit = 100  # mediamagic/exts/upload.py L243
+    # Files sent per message, discord allows up to 10
+    attachments_per_message = int(os.getenv("ATTACHMENTS_PER_MESSAGE", 10))
+    # Files of a url group which may be downloading or waiting for upload at once
+    pipeline_depth = int(os.getenv("PIPELINE_DEPTH", 10))
+    download_cache_dir = os.getenv("DOWNLOAD_CACHE_DIR", ".cache/downloads")
+    # Byte budget of the download cache, 0 disables it
+    download_cache_size = int(os.getenv("DOWNLOAD_CACHE_SIZE", 20 * 1024**3))
+    # Shared downloads are staged here before being linked into every job directory
+    staging_dir = os.getenv("STAGING_DIR", ".cache/inflight")
+    # Multiplex /upload downloads over HTTP/2, needs httpx[http2]
+    http2_downloads = os.getenv("HTTP2_DOWNLOADS", "false").lower() == "true"
+    # Parallel range requests fetching one /upload download of at least 64 Mb
+    download_connections = int(os.getenv("DOWNLOAD_CONNECTIONS", 4))
+    # Resume interrupted /upload downloads with Range requests instead of restarting
+    resumable_downloads = os.getenv("RESUMABLE_DOWNLOADS", "true").lower() == "true"
+    # Order of /upload downloads after probing: none, shortest or largest
+    download_schedule = os.getenv("DOWNLOAD_SCHEDULE", "shortest")
+    # Cut oversized mkv, webm, flv and ts downloads into parts while downloading
+    stream_segment = os.getenv("STREAM_SEGMENT", "true").lower() == "true"
+    # VidSegmenter.segment implementation: v2 (videosegmenter binary), v1 or the
+    # opt-in in-tree engines v3, v4 and hls
+    segment_engine = os.getenv("SEGMENT_ENGINE", "v2")
+    # Oversized files of an upload segmented ahead of the one being uploaded
+    segment_ahead = int(os.getenv("SEGMENT_AHEAD", 2))
+    # Concurrent ffprobe runs, they are short and CPU bound
+    probe_jobs = int(os.getenv("PROBE_JOBS", os.cpu_count() or 4))
+    # Concurrent ffmpeg and videosegmenter runs, mostly bound by disk throughput
+    ffmpeg_jobs = int(os.getenv("FFMPEG_JOBS", min(4, os.cpu_count() or 4)))
+    # Bytes of extracted archive members waiting for upload at once
+    extract_scratch = int(os.getenv("EXTRACT_SCRATCH", 4 * 1024**3))
+    # Largest expansion of an archive and total bytes extracted from one, zip bomb guards
+    extract_max_ratio = float(os.getenv("EXTRACT_MAX_RATIO", 100))
+    extract_max_total = int(os.getenv("EXTRACT_MAX_TOTAL", 64 * 1024**3))
+    # Messages being uploaded at once over all channels, one per channel at a time
+    upload_jobs = int(os.getenv("UPLOAD_JOBS", 8))
+
+
+class HttpPolicy:
+    # host (or parent domain): (max concurrent requests, requests per second, burst)
+    hosts = {
+        "ytshorts.savetube.me": (4, 2, 4),
+        "top.gg": (2, 1, 2),
+        "xham.live": (4, 5, 10),
+        **json.loads(os.getenv("HTTP_HOST_LIMITS", "{}")),
+    }
+    default = (8, None, 1)
+    # Concurrent requests to an unlisted host once it answered over HTTP/2
+    http2_streams = int(os.getenv("HTTP2_STREAMS", 64))
+
+
+class Transcode:
+    # Re-encode oversized videos into fewer pieces: off, auto (cost model) or always
+    mode = os.getenv("TRANSCODE_MODE", "off")
+    preset = os.getenv("TRANSCODE_PRESET", "veryfast")
+    # Encoding speed of the preset on a 1080p30 input, in multiples of realtime
+    speed = float(os.getenv("TRANSCODE_SPEED", 2.0))
+    # Lowest video bitrate worth encoding at, in bits per pixel per frame
+    min_bpp = float(os.getenv("TRANSCODE_MIN_BPP", 0.04))
+    audio_bitrate = 128_000
+    # Upload throughput in bytes per second and fixed cost of a message in seconds
+    upload_bandwidth = float(os.getenv("UPLOAD_BANDWIDTH", 8 * 1024**2))
+    message_cost = float(os.getenv("MESSAGE_COST", 1.0))
 
 
 class BinPath:
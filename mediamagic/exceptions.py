@@ -7,6 +7,18 @@ class ModelOffline(Exception):
     """
 
 
+class UnsupportedPlaylist(Exception):
+    """
+    Raised when a m3u8 playlist can't be fetched natively
+    """
+
+
+class UnsafeArchive(Exception):
+    """
+    Raised when an archive exceeds the extraction limits, like a zip bomb
+    """
+
+
 class Premium_Owner(commands.errors.CheckFailure):
     """
     Raised when premium user isn't the owner of the current server
@@ -4,11 +4,11 @@ from textwrap import shorten
 from typing import Literal, Set
 
 import disnake
-import httpx
 from disnake.ext import commands
 
 from mediamagic.bot import MediaMagic
 from mediamagic.constants import Client
+from mediamagic.services.httpclient import http_manager
 
 logger = logging.getLogger(__name__)
 nsfw_api = Client.nsfw_api
@@ -17,7 +17,7 @@ nsfw_api = Client.nsfw_api
 class Fun(commands.Cog):
     def __init__(self, client: MediaMagic) -> None:
         self.bot = client
-        self.http_client = httpx.AsyncClient()
+        self.http_client = http_manager.api
 
     @commands.slash_command(name="nsfw", nsfw=True, dm_permission=False)
     @commands.cooldown(1, 10, commands.cooldowns.BucketType.user)
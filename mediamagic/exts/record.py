@@ -1,15 +1,18 @@
+import functools
 import logging
 import time
 from pathlib import Path
 from typing import Dict, Set, Union
 
 import disnake
-import httpx
 from disnake.ext import commands
 
 from mediamagic.bot import MediaMagic
 from mediamagic.checks import is_premium_user
 from mediamagic.exceptions import ModelOffline
+from mediamagic.services.filesizelimit import file_size_limits
+from mediamagic.services.httpclient import http_manager
+from mediamagic.services.scheduler import Priority, media_context
 from mediamagic.services.striplivecam import NsfwLiveCam
 from mediamagic.services.upload import UploadService
 
@@ -47,7 +50,7 @@ class Recorder(commands.Cog):
         model: str,
     ):
         recorder = NsfwLiveCam(
-            model_name=model, out_dir=Path("."), client=httpx.AsyncClient()
+            model_name=model, out_dir=Path("."), client=http_manager.api
         )
         start = time.perf_counter()
         msg = None
@@ -72,11 +75,15 @@ class Recorder(commands.Cog):
             f"Stream Duration: {(time.perf_counter() - start)/60:.2f}", delete_after=5
         )
         try:
-            await self.uploadservice.upload(
-                inter,
-                Path(recorder.filename),
-                float(inter.guild.filesize_limit / 1024**2),
-            )
+            with media_context(inter.guild.id, Priority.INTERACTIVE):
+                await self.uploadservice.upload(
+                    inter,
+                    Path(recorder.filename),
+                    await file_size_limits.resolve(
+                        inter.guild,
+                        functools.partial(self.uploadservice.probe_limit, inter),
+                    ),
+                )
         except Exception as e:
             logger.error("Unable to upload", exc_info=e)
         else:
@@ -110,7 +117,7 @@ class Recorder(commands.Cog):
     @slash_record.autocomplete("model")
     async def models_suggestions(self, _, name: str) -> Set | Dict:
         return await NsfwLiveCam(
-            model_name="", out_dir=Path("."), client=httpx.AsyncClient()
+            model_name="", out_dir=Path("."), client=http_manager.api
         ).get_suggestions(name)
 
     @commands.command(name="record", aliases=["r"])
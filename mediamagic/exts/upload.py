@@ -3,18 +3,21 @@ import functools
 import io
 import logging
 from pathlib import Path
-from typing import Optional, Set, Union
+from typing import List, Optional, Set, Union
 from uuid import uuid4
 from zipfile import ZipFile
 
 import disnake
-import httpx
 from disnake.ext import commands
 
 from mediamagic.bot import MediaMagic
 from mediamagic.checks import is_premium_owner, is_premium_user
 from mediamagic.constants import Client
 from mediamagic.services.adownloader import Adownloader
+from mediamagic.services.cache import DownloadCache
+from mediamagic.services.filesizelimit import file_size_limits
+from mediamagic.services.httpclient import http_manager
+from mediamagic.services.scheduler import Priority, media_context
 from mediamagic.services.terabox import TeraExtractor
 from mediamagic.services.upload import UploadService
 
@@ -28,6 +31,13 @@ class Upload(commands.Cog):
         self.bot = bot
         self.uploadservice = UploadService()
         self.active_producer = set()
+        # Concurrent uploads started by serv which nothing awaits
+        self.uploads: Set[asyncio.Task] = set()
+        self.download_cache = (
+            DownloadCache(Path(Client.download_cache_dir), Client.download_cache_size)
+            if Client.download_cache_size
+            else None
+        )
 
     async def consumer(self, guild_id: int):
         logger.info(f"Consumer task created for {guild_id}")
@@ -65,6 +75,14 @@ class Upload(commands.Cog):
                 )
         logger.info(f"Consumer task completed for {guild_id}")
 
+    @commands.Cog.listener()
+    async def on_guild_update(
+        self, before: disnake.Guild, after: disnake.Guild
+    ) -> None:
+        """Drops the cached upload limit of a guild whose boost level changed"""
+        if before.premium_tier != after.premium_tier:
+            file_size_limits.forget(after.id)
+
     @commands.slash_command(name="nsfw_toggle")
     async def nsfw_toggle(
         self,
@@ -141,24 +159,14 @@ class Upload(commands.Cog):
             "Your upload is being queued, Upload will be completed soon!",
             ephemeral=True,
         )
-        await self.serv(inter, link)
+        await self.serv(inter, link, priority=Priority.INTERACTIVE)
 
-    async def serv(
+    async def _url_groups(
         self,
         inter: disnake.GuildCommandInteraction,
         attachment: Union[disnake.Attachment, Path, str],
-        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
-        sequential_upload: bool = True,
-    ):
-        """
-        Serves the provided attachment
-
-        Parameters
-        ----------
-        attachment : The text file/Path/str containing the links to download
-        channel : The channel to upload the files
-        sequential_upload : Whether to upload the files sequentially or concurrently
-        """
+    ) -> List[Set[str]]:
+        """Reads the links of attachment, resolves terabox ones and batches them"""
         if isinstance(attachment, Path):
             url_buff = attachment.read_text()
         elif isinstance(attachment, str):
@@ -176,66 +184,137 @@ class Upload(commands.Cog):
 
         logger.debug(f"TeraBox Links {len(tera_set)=}")
         if tera_set:
-            async with httpx.AsyncClient(
-                timeout=httpx.Timeout(None, read=None),
-                follow_redirects=True,
-                limits=httpx.Limits(max_connections=10),
-            ) as client:
-                extractor = TeraExtractor(
-                    tera_set,
-                    "Magic Browser",
-                    client,
-                )
-                data = await extractor()
-                logger.info(f"Resolved TeraBox Links {len(data)=}")
-                url_set.update({url.fast_link for url in data if url is not None})
+            extractor = TeraExtractor(
+                tera_set,
+                "Magic Browser",
+                http_manager.download,
+            )
+            data = await extractor()
+            logger.info(f"Resolved TeraBox Links {len(data)=}")
+            url_set.update({url.fast_link for url in data if url is not None})
 
         url_list = list(url_set)
         # Batches urls into groups
-        url_grp = [
-            url_list[i : i + Client.url_group_limit]
+        return [
+            set(url_list[i : i + Client.url_group_limit])
             for i in range(0, len(url_list), Client.url_group_limit)
         ]
-        for idx, url in enumerate(url_grp, 1):
-            url = set(url)
 
+    async def _dwnld(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        urls: Set[str],
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]],
+        sequential_upload: bool = True,
+        priority: Priority = Priority.BULK,
+    ) -> None:
+        """Downloads a group of urls and uploads the files as they arrive"""
+        # The first upload to a guild confirms its limit with a probe
+        max_file_size = await file_size_limits.resolve(
+            inter.guild,
+            functools.partial(self.uploadservice.probe_limit, inter, channel=channel),
+        )
+        downloader = Adownloader(
+            urls=urls,
+            cache=self.download_cache,
+            client=(
+                http_manager.download_h2
+                if Client.http2_downloads
+                else http_manager.download
+            ),
+            http2=Client.http2_downloads,
+            resumable=Client.resumable_downloads,
+            connections=Client.download_connections,
+            schedule=Client.download_schedule,  # type: ignore[arg-type]
+            stream_segment=(
+                functools.partial(file_size_limits.limit, inter.guild)
+                if Client.stream_segment
+                else None
+            ),
+        )
+        destination = Path(str(uuid4()))
+        destination.mkdir()
+        # Files are uploaded as soon as they are downloaded, either
+        # awaited or via task
+
+        async def _upload():
+            logger.info(f"Uploading from {destination}")
+            try:
+                await self.uploadservice.upload_stream(
+                    inter,
+                    downloader.stream(destination, max_pending=Client.pipeline_depth),
+                    destination,
+                    max_file_size,
+                    channel=channel,
+                    expected_size=downloader.expected_size,
+                )
+            except Exception as e:
+                logger.error("Upload Failed", exc_info=e)
+
+        # Media jobs of the upload are scheduled fairly against other guilds
+        with media_context(inter.guild.id, priority):
+            if sequential_upload:
+                logger.info("Doing Sequential Upload")
+                await _upload()
+            else:
+                logger.info("Doing Concurrent Upload")
+                # Held until done, the loop only keeps weak references to tasks
+                task = asyncio.create_task(_upload())
+                self.uploads.add(task)
+                task.add_done_callback(self.uploads.discard)
+
+    async def serv(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        attachment: Union[disnake.Attachment, Path, str],
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
+        sequential_upload: bool = True,
+        priority: Priority = Priority.BULK,
+    ):
+        """
+        Serves the provided attachment
+
+        Parameters
+        ----------
+        attachment : The text file/Path/str containing the links to download
+        channel : The channel to upload the files
+        sequential_upload : Whether to upload the files sequentially or concurrently
+        priority : Priority of the media jobs of this upload
+        """
+        for urls in await self._url_groups(inter, attachment):
             # for every url group _dwnld is called,
             # then a group is passed to Adownloader on by one
-            async def _dwnld(urls: Set[str]):
-                downloader = Adownloader(urls=urls)
-                destination = await downloader.download()
-                # After downloading a group we upload them via task or await
-
-                async def _upload():
-                    logger.info(f"Uploading from {destination}")
-                    try:
-                        await self.uploadservice.upload(
-                            inter,
-                            destination,
-                            # For safe side we decrease discord file size limit by 1
-                            # float((inter.guild.filesize_limit / 1024**2) - 1),
-                            int((inter.guild.filesize_limit / 1024**2)),
-                            channel=channel,
-                        )
-                    except Exception as e:
-                        logger.error("Upload Failed", exc_info=e)
-
-                if sequential_upload:
-                    logger.info("Doing Sequential Upload")
-                    await _upload()
-                else:
-                    logger.info("Doing Concurrent Upload")
-                    asyncio.create_task(_upload())
-
-            # Puts downloader with uploader function in queue
-            func = functools.partial(_dwnld, url)
-            logger.debug(f"Queued {len(url)} urls in _dwnld")
+            func = functools.partial(
+                self._dwnld, inter, urls, channel, sequential_upload, priority
+            )
+            logger.debug(f"Queued {len(urls)} urls in _dwnld")
             await self.queue.put((func, inter.guild.id, inter))  # Producer
         # Create consumer task for this guild and put it in active producer set
         if not (inter.guild.id in self.active_producer):
             self.active_producer.add(inter.guild.id)
             asyncio.create_task(self.consumer(inter.guild.id))
 
+    async def serv_channel(
+        self,
+        inter: disnake.GuildCommandInteraction,
+        attachment: Path,
+        channel: Union[disnake.TextChannel, disnake.ThreadWithMessage],
+        slots: asyncio.Semaphore,
+    ) -> None:
+        """
+        Uploads the links of attachment to channel, returns once all are uploaded
+
+        Bypasses the guild queue, so uploads to several channels run side by side,
+        as many at once as slots allows. The url groups of the channel are uploaded
+        one after the other, keeping its messages in order.
+        """
+        async with slots:
+            try:
+                for urls in await self._url_groups(inter, attachment):
+                    await self._dwnld(inter, urls, channel)
+            except Exception as e:
+                logger.error(f"Cloning into {channel} failed", exc_info=e)
+
     @commands.slash_command(name="clone")
     @is_premium_owner()
     async def clone(_):
@@ -258,10 +337,13 @@ class Upload(commands.Cog):
         zip_path = Path(str(uuid4()))
         zip.extractall(zip_path)
 
+        slots = asyncio.Semaphore(max(1, Client.upload_jobs))
+
         async def _serv(file):
             logger.info(f"Creating thread for {file.stem}")
             channel = await inter.guild.create_text_channel(name=file.stem)
-            await self.serv(inter, file, channel=channel)
+            # Channels upload in parallel, each one in order
+            await self.serv_channel(inter, file, channel, slots)
 
         tasks = (_serv(file) for file in zip_path.iterdir())
         await asyncio.gather(*tasks)
@@ -288,10 +370,13 @@ class Upload(commands.Cog):
         zip_path = Path(str(uuid4()))
         zip.extractall(zip_path)
 
+        slots = asyncio.Semaphore(max(1, Client.upload_jobs))
+
         async def _serv(file):
             logger.info(f"Creating thread for {file.stem}")
             thread = await channel.create_thread(name=file.stem, content="_ _")
-            await self.serv(inter, file, channel=thread)
+            # Threads upload in parallel, each one in order
+            await self.serv_channel(inter, file, thread, slots)
 
         tasks = (_serv(file) for file in zip_path.iterdir())
         await asyncio.gather(*tasks)
@@ -1,23 +1,173 @@
 import asyncio
+import contextlib
+import dataclasses
+import json
 import logging
+import os
 import time
+from functools import partial
 from pathlib import Path
-from typing import Set
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+)
 from urllib.parse import urlparse
-from uuid import uuid4
+from uuid import NAMESPACE_URL, uuid4, uuid5
 
 import aiofiles
 import httpx
 from ffmpeg.asyncio import FFmpeg
 
+from mediamagic.exceptions import UnsupportedPlaylist
+from mediamagic.services.cache import DownloadCache
+from mediamagic.services.hls import HLSDownloader
+from mediamagic.services.httpclient import http2_available, http_manager
+from mediamagic.services.scheduler import media_scheduler
+from mediamagic.services.singleflight import SingleFlight, shared_flights
+from mediamagic.services.videosegmenter import VidSegmenter
+from mediamagic.utils.sniff import retype, sniff
+
+
+@dataclasses.dataclass
+class DownloadJournal:
+    """Sidecar journal of the bytes of a file which are safely written to disk"""
+
+    url: str
+    written: int = 0
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @classmethod
+    def load(cls, path: Path, url: str) -> "DownloadJournal":
+        """Loads the journal from path, returns a fresh one if missing or stale"""
+        try:
+            journal = cls(**json.loads(path.read_text()))
+        except (OSError, ValueError, TypeError):
+            return cls(url)
+        if journal.url != url:
+            return cls(url)
+        return journal
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(dataclasses.asdict(self)))
+        tmp.replace(path)
+
+    def validates(self, response: httpx.Response) -> bool:
+        """Checks the resumed response still serves the journaled resource"""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if self.etag and etag:
+            return self.etag == etag
+        if self.last_modified and last_modified:
+            return self.last_modified == last_modified
+        return not (self.etag or self.last_modified)
+
+
+# Content types a media link never answers with, mostly error and login pages
+NON_MEDIA_TYPES = {
+    "text/html",
+    "text/plain",
+    "text/xml",
+    "application/json",
+    "application/xml",
+    "application/xhtml+xml",
+}
+# Containers ffmpeg can demux front to back from a pipe, by extension and type
+STREAMABLE = {".mkv", ".webm", ".flv", ".ts", ".mpg", ".mpeg"}
+STREAMABLE_TYPES = {
+    "video/x-matroska",
+    "video/webm",
+    "video/x-flv",
+    "video/mp2t",
+    "video/mpeg",
+}
+# Bytes read before deciding, enough for the header and a few keyframe intervals
+STREAM_HEAD_SIZE = 8 * 1024**2
+# Probes go through the download client which never times out, a silent server
+# must not hold up the links probed along with it
+PROBE_TIMEOUT = httpx.Timeout(10)
+
+
+@dataclasses.dataclass(frozen=True)
+class ProbeResult:
+    """Metadata of a url learnt from a HEAD request"""
+
+    url: str
+    status: int
+    size: Optional[int] = None
+    accept_ranges: bool = False
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_type: Optional[str] = None
+
 
 class Adownloader:
     def __init__(
-        self, urls: Set, logger: logging.Logger = logging.getLogger("adownloader")
+        self,
+        urls: Set,
+        logger: logging.Logger = logging.getLogger("adownloader"),
+        resumable: bool = False,
+        max_retries: int = 5,
+        journal_interval: int = 8 * 1024**2,
+        connections: int = 1,
+        segment_threshold: int = 64 * 1024**2,
+        hls_concurrency: int = 8,
+        cache: Optional[DownloadCache] = None,
+        single_flight: Optional[SingleFlight] = shared_flights,
+        client: Optional[httpx.AsyncClient] = None,
+        http2: bool = False,
+        schedule: Literal["none", "shortest", "largest"] = "none",
+        stream_segment: Optional[Callable[[], int]] = None,
     ) -> None:
-        self._downloaded = set()
+        """
+        Parameters
+        ----------
+        urls : The urls to download
+        resumable : Journal the written bytes and resume failed http downloads via Range requests
+        max_retries : Number of times a resumable download is retried after failing
+        journal_interval : Amount of bytes written between two journal checkpoints
+        connections : Number of parallel range requests used for a single large file
+        segment_threshold : Minimum size of a file to be fetched over multiple connections
+        hls_concurrency : Number of m3u8 segments fetched at the same time per playlist
+        cache : Download cache serving repeated links without refetching them
+        single_flight : Registry sharing transfers with other downloaders, None disables it
+        client : Shared http client to use, a private one is opened per download if not set
+        http2 : Multiplex the requests of the private client and of shared transfers over
+            HTTP/2
+        schedule : Probe links before downloading, drop dead and non media ones and start
+            the rest shortest first (latency) or largest first (makespan)
+        stream_segment : Returns the size in Mb when a download starts, larger downloads
+            of a streamable container are cut into parts of that size while downloading
+            instead of being written whole
+        """
+        self._downloaded: Dict[str, Path] = {}
+        self._validators: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
         self.urls = {x.strip() for x in urls}
         self.logger = logger
+        self.resumable = resumable
+        self.max_retries = max_retries
+        self.journal_interval = journal_interval
+        self.connections = connections
+        self.segment_threshold = segment_threshold
+        self.hls_concurrency = hls_concurrency
+        self.cache = cache
+        self.single_flight = single_flight
+        self.client = client
+        self.http2 = http2 and http2_available()
+        self.schedule = schedule
+        self.stream_segment = stream_segment
+        self.probes: Dict[str, ProbeResult] = {}
+        # Urls downloaded as parts, their last part doesn't have the announced size
+        self._streamed: Set[str] = set()
 
     def _get_file_ext_from_url(self, url: str) -> str:
         path = urlparse(url).path
@@ -25,9 +175,544 @@ class Adownloader:
             return path.split("/")[-1][-10:]
         return f"{path.split('/')[-1]}.mp4"
 
-    async def _httpx_download(
+    async def _probe(self, url: str, client: httpx.AsyncClient) -> ProbeResult:
+        """
+        Probes size, type and range support of url with a HEAD request
+
+        Servers refusing HEAD are asked for a zero byte range instead, results are
+        remembered in self.probes. Raises httpx.TimeoutException when the server
+        doesn't answer within PROBE_TIMEOUT, the size is unknown then.
+        """
+        if (probe := self.probes.get(url)) is not None:
+            return probe
+        headers = {"User-Agent": "Magic Browser"}
+        response = await client.head(
+            url, follow_redirects=True, headers=headers, timeout=PROBE_TIMEOUT
+        )
+        if response.status_code in (403, 405, 501):
+            async with client.stream(
+                "GET",
+                url,
+                follow_redirects=True,
+                headers={**headers, "Range": "bytes=0-0"},
+                timeout=PROBE_TIMEOUT,
+            ) as response:
+                pass
+        if response.status_code == 206:
+            length = response.headers.get("Content-Range", "").split("/")[-1]
+            status = 200
+        else:
+            length = response.headers.get("Content-Length", "")
+            status = response.status_code
+        content_type = response.headers.get("Content-Type")
+        probe = ProbeResult(
+            url=str(response.url),
+            status=status,
+            size=int(length) if length.isdigit() else None,
+            accept_ranges=response.status_code == 206
+            or response.headers.get("Accept-Ranges", "").lower() == "bytes",
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            content_type=(
+                content_type.split(";")[0].strip().lower() if content_type else None
+            ),
+        )
+        self.probes[url] = probe
+        return probe
+
+    async def _preflight(self, urls: Set[str], client: httpx.AsyncClient) -> List[str]:
+        """Probes urls in parallel, returns the downloadable ones in schedule order"""
+        results = await asyncio.gather(
+            *(self._probe(url, client) for url in urls), return_exceptions=True
+        )
+        sizes: Dict[str, Optional[int]] = {}
+        for url, probe in zip(urls, results):
+            if isinstance(probe, BaseException):
+                self.logger.debug(f"Probe of {url} failed {probe!r}")
+                sizes[url] = None
+            elif probe.status in (404, 410):
+                self.logger.info(f"Dropping dead link {url} ({probe.status})")
+            elif probe.content_type in NON_MEDIA_TYPES:
+                self.logger.info(
+                    f"Dropping non media link {url} ({probe.content_type})"
+                )
+            else:
+                sizes[url] = probe.size
+        # Links of unknown size go last in either order
+        if self.schedule == "shortest":
+            return sorted(sizes, key=lambda x: (sizes[x] is None, sizes[x] or 0))
+        return sorted(sizes, key=lambda x: (sizes[x] is None, -(sizes[x] or 0)))
+
+    def expected_size(self, file: Path) -> Optional[int]:
+        """Returns the size announced by the server for a downloaded file"""
+        for url, path in self._downloaded.items():
+            if (
+                path == file
+                and url not in self._streamed
+                and (probe := self.probes.get(url)) is not None
+            ):
+                return probe.size
+        return None
+
+    async def _fetch_range(
+        self,
+        probe: ProbeResult,
+        file_name: Path,
+        start: int,
+        end: int,
+        client: httpx.AsyncClient,
+    ) -> None:
+        """Fetches bytes start-end (inclusive) of probe.url into the same offsets of file_name"""
+        offset = start
+        for attempt in range(self.max_retries + 1):
+            headers = {"User-Agent": "Magic Browser", "Range": f"bytes={offset}-{end}"}
+            if validator := probe.etag or probe.last_modified:
+                headers["If-Range"] = validator
+            try:
+                async with client.stream(
+                    "GET", probe.url, follow_redirects=True, headers=headers
+                ) as response:
+                    if response.status_code != 206:
+                        raise RuntimeError(
+                            f"Range request answered with {response.status_code}"
+                        )
+                    async with aiofiles.open(file_name, mode="r+b") as file:
+                        await file.seek(offset)
+                        async for chunk in response.aiter_bytes():
+                            # Guard against servers sending more than asked
+                            chunk = chunk[: end + 1 - offset]
+                            await file.write(chunk)
+                            offset += len(chunk)
+                            if offset > end:
+                                break
+                if offset > end:
+                    return
+                raise httpx.ReadError("Range response ended early")
+            except httpx.HTTPError as e:
+                self.logger.debug(
+                    f"Range {start}-{end} of {probe.url} interrupted at {offset}: {e!r}"
+                )
+                await asyncio.sleep(min(2**attempt, 30))
+        raise RuntimeError(
+            f"Range {start}-{end} failed after {self.max_retries} retries"
+        )
+
+    async def _segmented_download(
+        self, url: str, probe: ProbeResult, dir: Path, client: httpx.AsyncClient
+    ) -> bool:
+        """
+        Downloads url over self.connections parallel range requests into a preallocated file
+
+        Returns False if the ranged download failed and the file was discarded
+        """
+        assert probe.size is not None
+        file_name = dir.joinpath(str(uuid4()) + "." + self._get_file_ext_from_url(url))
+        async with aiofiles.open(file_name, mode="wb") as file:
+            if hasattr(os, "posix_fallocate"):
+                await asyncio.to_thread(
+                    os.posix_fallocate, file.fileno(), 0, probe.size
+                )
+            else:
+                await file.truncate(probe.size)
+
+        part = -(-probe.size // self.connections)
+        ranges = [
+            (start, min(start + part, probe.size) - 1)
+            for start in range(0, probe.size, part)
+        ]
+        self.logger.debug(f"Fetching {url} as {len(ranges)} ranges of {part} bytes")
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for start, end in ranges:
+                    tg.create_task(
+                        self._fetch_range(probe, file_name, start, end, client)
+                    )
+        except Exception as e:
+            self.logger.warning(f"Ranged download of {url} failed", exc_info=e)
+            file_name.unlink(missing_ok=True)
+            return False
+        self._finished(url, file_name, probe.etag, probe.last_modified)
+        return True
+
+    def _finished(
+        self,
+        url: str,
+        file: Path,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        """Records the file url was downloaded to along with its validators"""
+        self._downloaded[url] = file
+        self._validators[url] = (etag, last_modified)
+
+    async def _from_cache(
         self, url: str, dir: Path, client: httpx.AsyncClient
+    ) -> Optional[Path]:
+        """Links the cached copy of url into dir if it is still valid"""
+        assert self.cache is not None
+        if (entry := self.cache.lookup(url)) is None:
+            return None
+        if entry.etag or entry.last_modified:
+            try:
+                probe = await self._probe(url, client)
+            except httpx.HTTPError as e:
+                self.logger.debug(f"Revalidation of {url} failed {e!r}")
+                return None
+            if (entry.etag, entry.last_modified) != (
+                probe.etag,
+                probe.last_modified,
+            ):
+                self.logger.debug(f"Cached copy of {url} is stale")
+                self.cache.forget(url)
+                return None
+        elif not self.cache.is_fresh(entry):
+            self.cache.forget(url)
+            return None
+        file_name = dir.joinpath(str(uuid4()) + "." + self._get_file_ext_from_url(url))
+        if (file := await self.cache.checkout(entry, file_name)) is None:
+            # A miss, the entry is refetched and stored again
+            self.cache.forget(url)
+        return file
+
+    async def _resuming(
+        self,
+        url: str,
+        chunks: AsyncIterator[bytes],
+        validators: Tuple[Optional[str], Optional[str]],
+        client: httpx.AsyncClient,
+        retries: int,
+    ) -> AsyncGenerator[bytes, None]:
+        """Yields chunks and continues a body breaking off with Range requests"""
+        offset = 0
+        response: Optional[httpx.Response] = None
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    if attempt:
+                        headers = {
+                            "User-Agent": "Magic Browser",
+                            "Range": f"bytes={offset}-",
+                        }
+                        if validator := validators[0] or validators[1]:
+                            headers["If-Range"] = validator
+                        response = await client.send(
+                            client.build_request("GET", url, headers=headers),
+                            stream=True,
+                            follow_redirects=True,
+                        )
+                        content_range = response.headers.get("Content-Range", "")
+                        if response.status_code != 206 or not content_range.startswith(
+                            f"bytes {offset}-"
+                        ):
+                            raise RuntimeError(
+                                f"Resuming {url} at {offset} answered with "
+                                f"{response.status_code} {content_range}"
+                            )
+                        chunks = response.aiter_bytes()
+                    async for chunk in chunks:
+                        offset += len(chunk)
+                        yield chunk
+                    return
+                except httpx.HTTPError as e:
+                    if response is not None:
+                        await response.aclose()
+                        response = None
+                    if attempt == retries:
+                        raise
+                    self.logger.warning(
+                        f"Download of {url} interrupted at {offset} bytes "
+                        f"({attempt + 1}/{retries + 1}): {e!r}"
+                    )
+                    await asyncio.sleep(min(2**attempt, 30))
+        finally:
+            if response is not None:
+                await response.aclose()
+
+    async def _segment_while_downloading(
+        self,
+        url: str,
+        dir: Path,
+        client: httpx.AsyncClient,
+        on_part: Callable[[Path], Awaitable[None]],
+    ) -> bool:
+        """
+        Pipes the body of a large streamable url into the segmenter as it downloads
+
+        Whether url is worth cutting this way is decided from its probe, False is
+        returned without any request if not. Otherwise parts are handed to on_part as
+        soon as ffmpeg closes them, ffmpeg gets no more input until on_part returns.
+        The body is never requested again from the start: a head ffmpeg can't cut
+        from a pipe, or ffmpeg failing before the first part, falls back to writing
+        the body whole with the bytes read so far. A body breaking off is continued
+        with Range requests where the server supports them.
+        """
+        assert self.stream_segment is not None
+        # Read per download, the upload limit may have been lowered meanwhile
+        max_size = self.stream_segment()
+        try:
+            probe = await self._probe(url, client)
+        except httpx.HTTPError as e:
+            self.logger.debug(f"HEAD probe of {url} failed {e!r}")
+            return False
+        suffix = Path(urlparse(url).path).suffix.lower()
+        if (
+            probe.status != 200
+            or probe.size is None
+            or probe.size <= max_size * 1024**2
+            or not (probe.content_type in STREAMABLE_TYPES or suffix in STREAMABLE)
+        ):
+            return False
+        whole = dir.joinpath(str(uuid4()) + "." + self._get_file_ext_from_url(url))
+        prefix = str(uuid4())
+        parts: List[Path] = []
+        chunks: Optional[AsyncGenerator[bytes, None]] = None
+        try:
+            async with client.stream(
+                "GET",
+                url,
+                follow_redirects=True,
+                headers={"User-Agent": "Magic Browser"},
+            ) as response:
+                if response.status_code != 200:
+                    self.logger.critical(
+                        f"Server returned {response.status_code} for {url}"
+                    )
+                    return True
+                validators = (
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+                chunks = self._resuming(
+                    url,
+                    response.aiter_bytes(),
+                    validators,
+                    client,
+                    self.max_retries if probe.accept_ranges else 0,
+                )
+                head = b""
+                async for chunk in chunks:
+                    head += chunk
+                    if len(head) >= STREAM_HEAD_SIZE:
+                        break
+                sniffed = sniff(head)
+                if sniffed.kind == "reject":
+                    self.logger.error(f"{url} did not return media, aborting")
+                    return True
+                segmenter = VidSegmenter(max_size)
+                duration, interval = None, None
+                if sniffed.ext in STREAMABLE:
+                    duration, interval = await segmenter.head_probe(head)
+                async with aiofiles.open(whole, mode="wb") as file:
+                    await file.write(head)
+                    if duration is None:
+                        self.logger.debug(
+                            f"{url} ({sniffed.ext}) can't be segmented from a pipe"
+                        )
+                        async for chunk in chunks:
+                            await file.write(chunk)
+                    else:
+                        # Seconds of the average bitrate fitting in a part
+                        budget = max_size * 1024**2 * 0.95 / (probe.size / duration)
+                        # Pieces run on to the next keyframe, so they are planned one
+                        # keyframe interval short, parts which still overshoot get
+                        # segmented on upload
+                        piece_time = max(budget - (interval or budget * 0.2), 0.1)
+                        self.logger.info(
+                            f"Segmenting {url} while downloading, "
+                            f"{piece_time=:.1f}s {interval=}s"
+                        )
+                        # Until the first part is passed on the body is written to
+                        # file too. The reader is never cancelled by a failing ffmpeg,
+                        # so the response stays usable for the whole download.
+                        teeing, piping = True, True
+                        pipe: asyncio.Queue[Optional[bytes]] = asyncio.Queue(16)
+                        # Cleared while a part waits to be taken by on_part
+                        room = asyncio.Event()
+                        room.set()
+
+                        async def _read() -> None:
+                            try:
+                                async for chunk in chunks:
+                                    if teeing:
+                                        await file.write(chunk)
+                                    elif not piping:
+                                        break
+                                    if piping:
+                                        await pipe.put(chunk)
+                            finally:
+                                if piping:
+                                    await pipe.put(None)
+
+                        async def _body() -> AsyncIterator[bytes]:
+                            yield head
+                            while (chunk := await pipe.get()) is not None:
+                                await room.wait()
+                                yield chunk
+                            # Raises when the download broke off, ffmpeg must not
+                            # take it for the end of the video
+                            await reader
+
+                        reader = asyncio.create_task(_read())
+                        try:
+                            async for part in segmenter.segment_stream(
+                                _body(),
+                                dir / prefix,
+                                ".webm" if sniffed.ext == ".webm" else ".mp4",
+                                piece_time,
+                            ):
+                                if teeing:
+                                    # Only needed to fall back to before the first part
+                                    teeing = False
+                                    whole.unlink(missing_ok=True)
+                                parts.append(part)
+                                room.clear()
+                                await on_part(part)
+                                room.set()
+                        except Exception:
+                            self.logger.exception(
+                                f"Segmenting {url} while downloading failed"
+                            )
+                            piping = False
+                            # Unblocks the reader in case it waits for room
+                            while not pipe.empty():
+                                pipe.get_nowait()
+                            if not teeing:
+                                # The parts passed on stay, the rest is lost
+                                return True
+                            self.logger.info(f"Downloading {url} whole instead")
+                            await reader
+                        else:
+                            self._streamed.add(url)
+                            self._finished(url, parts[-1], *validators)
+                            return True
+                        finally:
+                            reader.cancel()
+                            await asyncio.wait({reader})
+            await self._store(url, whole, validators)
+            self._validators[url] = validators
+            await self._settle(url, whole, client)
+            return True
+        except Exception:
+            self.logger.exception(f"Error while downloading {url}")
+            return True
+        finally:
+            if chunks is not None:
+                await chunks.aclose()
+            if url not in self._downloaded or parts:
+                whole.unlink(missing_ok=True)
+            # Unfinished pieces of a failed run
+            for leftover in dir.glob(f"{prefix}_*"):
+                if leftover not in parts:
+                    leftover.unlink()
+
+    async def _settle(self, url: str, file: Path, client: httpx.AsyncClient) -> None:
+        """
+        Records the download of url unless its content turns out not to be media
+
+        A playlist served without the m3u8 extension is fetched like the m3u8 links.
+        """
+        # Names derived from the url are only a guess, the content decides the type
+        file, sniffed = retype(file)
+        if sniffed.kind == "reject" or sniffed.ext == ".m3u8":
+            file.unlink()
+            if self.cache is not None:
+                self.cache.forget(url)
+        if sniffed.kind == "reject":
+            self.logger.error(f"{url} did not return media, discarding {file.name}")
+            return
+        if sniffed.ext == ".m3u8":
+            self.logger.info(f"{url} serves a playlist, downloading its segments")
+            await self.download_m3u8(url, file.parent, client)
+            return
+        self._finished(url, file, *self._validators.get(url, (None, None)))
+
+    async def _store(
+        self, url: str, file: Path, validators: Tuple[Optional[str], Optional[str]]
     ) -> None:
+        """Adds a finished download to the cache, failing to do so isn't fatal"""
+        if self.cache is None:
+            return
+        try:
+            await self.cache.store(url, file, *validators)
+        except OSError as e:
+            self.logger.warning(f"Unable to cache {url}", exc_info=e)
+
+    async def _httpx_download(
+        self,
+        url: str,
+        dir: Path,
+        client: httpx.AsyncClient,
+        on_part: Optional[Callable[[Path], Awaitable[None]]] = None,
+    ) -> None:
+        file: Optional[Path] = None
+        if self.cache is not None:
+            file = await self._from_cache(url, dir, client)
+        if file is not None:
+            self.logger.debug(f"Cache hit for {url}")
+            await self._settle(url, file, client)
+            return
+        key = DownloadCache.normalize_url(url)
+        if (
+            self.stream_segment is not None
+            and on_part is not None
+            # Joining a transfer in flight beats starting a second one
+            and (self.single_flight is None or key not in self.single_flight.flights)
+            and await self._segment_while_downloading(url, dir, client, on_part)
+        ):
+            return
+        if self.single_flight is None:
+            fetched = await self._fetch_shared(url, client, dir)
+        else:
+            fetched = await self.single_flight.do(
+                key,
+                partial(self._fetch_shared, url, self._shared_client),
+                dir,
+            )
+        if fetched is None:
+            return
+        file, self._validators[url] = fetched
+        await self._settle(url, file, client)
+
+    @property
+    def _shared_client(self) -> httpx.AsyncClient:
+        """Process wide client for transfers other downloaders may join"""
+        # The private client of the requester starting a flight closes with it
+        return http_manager.download_h2 if self.http2 else http_manager.download
+
+    async def _fetch_shared(
+        self, url: str, client: httpx.AsyncClient, dir: Path
+    ) -> Optional[Tuple[Path, Tuple[Optional[str], Optional[str]]]]:
+        """
+        Fetches and caches url, the unit of work shared by concurrent requesters
+
+        Returns the file along with its validators.
+        """
+        await self._fetch(url, dir, client)
+        if (file := self._downloaded.pop(url, None)) is None:
+            return None
+        validators = self._validators.pop(url, (None, None))
+        await self._store(url, file, validators)
+        return file, validators
+
+    async def _fetch(self, url: str, dir: Path, client: httpx.AsyncClient) -> None:
+        if self.connections > 1:
+            try:
+                probe = await self._probe(url, client)
+            except httpx.HTTPError as e:
+                self.logger.debug(f"HEAD probe of {url} failed {e!r}")
+            else:
+                if (
+                    probe.status == 200
+                    and probe.accept_ranges
+                    and probe.size is not None
+                    and probe.size >= self.segment_threshold
+                ):
+                    if await self._segmented_download(url, probe, dir, client):
+                        return
+                self.logger.debug(f"Single stream fallback for {url} {probe=}")
+        if self.resumable:
+            await self._resumable_download(url, dir, client)
+            return
         try:
             async with client.stream(
                 "GET",
@@ -42,67 +727,280 @@ class Adownloader:
                     file_name,
                     mode="wb",
                 ) as file:
+                    sniffed = None
                     async for chunk in response.aiter_bytes():
+                        if sniffed is None:
+                            sniffed = sniff(chunk)
+                            if sniffed.kind == "reject":
+                                break
                         await file.write(chunk)
+                if sniffed is not None and sniffed.kind == "reject":
+                    self.logger.error(f"{url} did not return media, aborting")
+                    file_name.unlink()
+                    return
                 if response.status_code != 200:
                     self.logger.critical(
                         f"Server returned {response.status_code} for {url}"
                     )
                     file_name.unlink()
-            self._downloaded.add(url)
+                    return
+            self._finished(
+                url,
+                file_name,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
         except Exception:
             self.logger.exception(f"Error while downloading {url}")
 
-    async def download_m3u8(self, url: str, dir: Path) -> None:
-        self.logger.debug(f"{dir=} {url=}")
+    @staticmethod
+    def _discard(file_name: Path, journal_path: Path) -> None:
+        """Removes the partial file of a failed download so it is never uploaded"""
+        file_name.unlink(missing_ok=True)
+        journal_path.unlink(missing_ok=True)
 
-        try:
-            ffmpeg = (
-                FFmpeg()
-                .option("y")
-                .input(url)
-                .output(dir.joinpath(str(uuid4()) + ".mp4"))
-            )
+    async def _resumable_download(
+        self, url: str, dir: Path, client: httpx.AsyncClient
+    ) -> None:
+        """Downloads url while journaling progress, resumes with Range requests on failure"""
+        # Deterministic name so that a restarted download finds its partial file
+        file_name = dir.joinpath(
+            str(uuid5(NAMESPACE_URL, url)) + "." + self._get_file_ext_from_url(url)
+        )
+        journal_path = file_name.with_name(file_name.name + ".journal")
+        journal = DownloadJournal.load(journal_path, url)
+        if not file_name.exists() or file_name.stat().st_size < journal.written:
+            journal = DownloadJournal(url)
+
+        for attempt in range(self.max_retries + 1):
+            headers = {"User-Agent": "Magic Browser"}
+            if journal.written:
+                headers["Range"] = f"bytes={journal.written}-"
+                if validator := journal.etag or journal.last_modified:
+                    headers["If-Range"] = validator
+            try:
+                async with client.stream(
+                    "GET", url, follow_redirects=True, headers=headers
+                ) as response:
+                    if response.status_code == 416 and journal.written:
+                        # Nothing left to fetch when the journal covers the whole file
+                        total = response.headers.get("Content-Range", "").split("/")[-1]
+                        if total.isdigit() and int(total) == journal.written:
+                            break
+                        self.logger.warning(f"Range rejected, restarting {url}")
+                        journal = DownloadJournal(url)
+                        continue
+                    if response.status_code == 206 and journal.validates(response):
+                        self.logger.debug(f"Resuming {url} from {journal.written}")
+                        mode = "r+b"
+                    elif response.status_code == 200:
+                        if journal.written:
+                            self.logger.info(f"Resource changed, restarting {url}")
+                        journal = DownloadJournal(
+                            url,
+                            etag=response.headers.get("ETag"),
+                            last_modified=response.headers.get("Last-Modified"),
+                        )
+                        # A finished file left behind may share its data with a cache
+                        # blob, it is replaced instead of truncated
+                        file_name.unlink(missing_ok=True)
+                        mode = "wb"
+                    elif response.status_code == 206:
+                        self.logger.info(f"Validator mismatch, restarting {url}")
+                        journal = DownloadJournal(url)
+                        continue
+                    else:
+                        self.logger.critical(
+                            f"Server returned {response.status_code} for {url}"
+                        )
+                        self._discard(file_name, journal_path)
+                        return
+
+                    async with aiofiles.open(file_name, mode=mode) as file:
+                        await file.seek(journal.written)
+                        await file.truncate()
+                        checkpoint = journal.written
+                        try:
+                            async for chunk in response.aiter_bytes():
+                                await file.write(chunk)
+                                journal.written += len(chunk)
+                                if (
+                                    journal.written - checkpoint
+                                    >= self.journal_interval
+                                ):
+                                    await file.flush()
+                                    journal.save(journal_path)
+                                    checkpoint = journal.written
+                        finally:
+                            await file.flush()
+                            journal.save(journal_path)
+                break
+            except httpx.HTTPError as e:
+                self.logger.warning(
+                    f"Download of {url} interrupted at {journal.written} bytes "
+                    f"({attempt + 1}/{self.max_retries + 1}): {e!r}"
+                )
+                await asyncio.sleep(min(2**attempt, 30))
+            except Exception:
+                self.logger.exception(f"Error while downloading {url}")
+                self._discard(file_name, journal_path)
+                return
+        else:
+            self.logger.critical(f"Giving up on {url} after {self.max_retries} retries")
+            self._discard(file_name, journal_path)
+            return
+
+        journal_path.unlink(missing_ok=True)
+        self._finished(url, file_name, journal.etag, journal.last_modified)
+
+    async def _ffmpeg_m3u8(self, url: str, out: Path) -> None:
+        """Lets ffmpeg fetch and mux the playlist, used for live and encrypted streams"""
+        ffmpeg = FFmpeg().option("y").input(url).output(out)
+        async with media_scheduler.job("ffmpeg"):
             await ffmpeg.execute()
-            self._downloaded.add(url)
+
+    async def _fetch_m3u8(
+        self, url: str, client: Optional[httpx.AsyncClient], dir: Path
+    ) -> Optional[Tuple[Path, None]]:
+        out = dir.joinpath(str(uuid4()) + ".mp4")
+        try:
+            if client is None:
+                await self._ffmpeg_m3u8(url, out)
+            else:
+                try:
+                    await HLSDownloader(client, self.hls_concurrency).download(url, out)
+                except UnsupportedPlaylist as e:
+                    self.logger.info(f"Falling back to ffmpeg: {e}")
+                    await self._ffmpeg_m3u8(url, out)
         except Exception:
             self.logger.exception(f"Error while downloading {url}")
+            out.unlink(missing_ok=True)
+            return None
+        return out, None
 
-    async def download(self) -> Path:
-        async with httpx.AsyncClient(
-            timeout=httpx.Timeout(None), limits=httpx.Limits(max_connections=5)
+    async def download_m3u8(
+        self, url: str, dir: Path, client: Optional[httpx.AsyncClient] = None
+    ) -> None:
+        self.logger.debug(f"{dir=} {url=}")
+        if self.single_flight is None:
+            fetched = await self._fetch_m3u8(url, client, dir)
+        else:
+            fetched = await self.single_flight.do(
+                DownloadCache.normalize_url(url),
+                partial(self._fetch_m3u8, url, client and self._shared_client),
+                dir,
+            )
+        if fetched is not None:
+            self._finished(url, fetched[0])
+
+    async def stream(
+        self, dir: Path, max_pending: Optional[int] = None
+    ) -> AsyncIterator[Path]:
+        """
+        Downloads all urls into dir, yielding every file as soon as it is finished
+
+        At most max_pending files are downloading or waiting to be consumed at a time,
+        a new download starts only after the consumer is done with a yielded file.
+        A part of a download segmented on the fly takes over the slot of its download,
+        which continues once it gets another one.
+        """
+        async with (
+            contextlib.nullcontext(self.client)
+            if self.client is not None
+            else httpx.AsyncClient(
+                timeout=httpx.Timeout(None),
+                limits=httpx.Limits(
+                    max_connections=max(5, self.connections, self.hls_concurrency)
+                ),
+                http2=self.http2,
+            )
         ) as client:
-            dir = Path(str(uuid4()))
-            dir.mkdir()
             m3u8_links = {
                 url for url in self.urls if urlparse(url).path.endswith(".m3u8")
             }
             httpx_links = self.urls - m3u8_links
-            timer_start = time.perf_counter()
-            if httpx_links:
-                self.logger.info(f"Downloading {len(httpx_links)} files")
-                task1 = (
-                    self._httpx_download(url=url, dir=dir, client=client)
-                    for url in httpx_links
+            if self.schedule != "none":
+                # Semaphore waiters are woken in order, so job order is start order
+                httpx_links = await self._preflight(httpx_links, client)
+            # Items are (file, whether the job of the file is done)
+            finished: asyncio.Queue[Tuple[Optional[Path], bool]] = asyncio.Queue()
+            jobs = [
+                (
+                    url,
+                    partial(self._httpx_download, url=url, dir=dir, client=client),
                 )
-                await asyncio.gather(*task1, return_exceptions=True)
+                for url in httpx_links
+            ] + [
+                (url, partial(self.download_m3u8, url, dir, client))
+                for url in m3u8_links
+            ]
+            slots = asyncio.Semaphore(max_pending or len(jobs) or 1)
+
+            async def _run(url, job) -> None:
+                await slots.acquire()
+                holding = True
+
+                async def _pass_on(part: Path) -> None:
+                    nonlocal holding
+                    finished.put_nowait((part, False))
+                    holding = False
+                    await slots.acquire()
+                    holding = True
 
-            if m3u8_links:
-                self.logger.info(f"Downloading {len(m3u8_links)} m3u8 files")
-                task2 = (self.download_m3u8(url, dir) for url in m3u8_links)
-                await asyncio.gather(*task2, return_exceptions=True)
+                try:
+                    if url in m3u8_links:
+                        await job()
+                    else:
+                        await job(on_part=_pass_on)
+                finally:
+                    # Parts of a streamed download were all passed on already
+                    file = None if url in self._streamed else self._downloaded.get(url)
+                    if file is None and holding:
+                        slots.release()
+                    finished.put_nowait((file, True))
+
+            self.logger.info(
+                f"Downloading {len(httpx_links)} files and {len(m3u8_links)} m3u8 files"
+            )
+            timer_start = time.perf_counter()
+            tasks = [asyncio.create_task(_run(url, job)) for url, job in jobs]
+            try:
+                remaining = len(tasks)
+                while remaining:
+                    file, done = await finished.get()
+                    remaining -= done
+                    if file is None:
+                        continue
+                    try:
+                        yield file
+                    finally:
+                        slots.release()
+            finally:
+                for task in tasks:
+                    task.cancel()
 
             self.logger.info(
                 f"{len(self.urls)} items downloaded within {time.perf_counter() - timer_start:.2f}"
             )
-            not_downloaded = self.urls - self._downloaded
+            not_downloaded = self.urls - self._downloaded.keys()
             if len(not_downloaded):
                 self.logger.info(f"Failed To Download {not_downloaded}")
+
+    async def download(self, dir: Optional[Path] = None) -> Path:
+        """
+        Downloads all urls into dir, a fresh directory is created if not provided
+
+        Passing the directory of an interrupted resumable download continues it
+        """
+        dir = dir or Path(str(uuid4()))
+        dir.mkdir(exist_ok=True)
+        async for _ in self.stream(dir):
+            pass
         return dir
 
 
 if __name__ == "__main__":
     import sys
 
-    downloader = Adownloader(urls={x for x in sys.argv[1:]})
+    downloader = Adownloader(urls={x for x in sys.argv[1:]}, resumable=True)
     asyncio.run(downloader.download())
@@ -0,0 +1,219 @@
+import asyncio
+import dataclasses
+import logging
+import tarfile
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import IO, AsyncIterator, Dict, Iterator, Optional, Tuple
+from uuid import uuid4
+
+from mediamagic.constants import Client
+from mediamagic.exceptions import UnsafeArchive
+from mediamagic.utils.sniff import retype
+
+logger = logging.getLogger("archive")
+
+CHUNK_SIZE = 1024**2
+# Expansion below this many bytes is never treated as a bomb, text compresses well
+RATIO_FLOOR = 64 * 1024**2
+
+
+@dataclasses.dataclass
+class _Progress:
+    size: int
+    extracted: int = 0
+
+
+def _entries(archive: Path) -> Iterator[Tuple[str, int, IO[bytes]]]:
+    """Opens the regular files of a zip or tar archive one after the other"""
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                try:
+                    member = zf.open(info)
+                except (RuntimeError, NotImplementedError) as e:
+                    # Encrypted or unsupported compression
+                    logger.warning(f"Skipping {info.filename}: {e}")
+                    continue
+                with member:
+                    yield info.filename, info.file_size, member
+        return
+    # Stream mode reads compressed tars front to back without seeking
+    with tarfile.open(archive, "r|*") as tar:
+        for info in tar:
+            # Links and devices are never extracted
+            if not info.isfile():
+                continue
+            member = tar.extractfile(info)
+            assert member is not None
+            yield info.name, info.size, member
+
+
+def _declared_size(archive: Path) -> Optional[int]:
+    """Returns the total size the central directory of a zip announces"""
+    if not zipfile.is_zipfile(archive):
+        return None
+    with zipfile.ZipFile(archive) as zf:
+        return sum(x.file_size for x in zf.infolist())
+
+
+def _flat_name(name: str) -> Optional[str]:
+    """Returns the file name of a member path, None for metadata of archivers"""
+    path = PurePosixPath(name.replace("\\", "/"))
+    if "__MACOSX" in path.parts or not path.name or path.name.startswith("."):
+        return None
+    return path.name
+
+
+class ArchiveExtractor:
+    """
+    Extracts archives member by member in a worker thread
+
+    Extraction runs ahead of the consumer as long as the members it handed out and
+    which still exist fit in the scratch space. Nested archives are flattened into
+    the same stream.
+    """
+
+    def __init__(
+        self,
+        scratch: int = Client.extract_scratch,
+        max_ratio: float = Client.extract_max_ratio,
+        max_total: int = Client.extract_max_total,
+        max_members: int = 10_000,
+        max_depth: int = 2,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        scratch : Bytes of extracted members allowed on disk at once
+        max_ratio : Largest ratio of extracted bytes to the size of an archive
+        max_total : Largest number of bytes extracted over all nested archives
+        max_members : Largest number of members over all nested archives
+        max_depth : Levels of archives within archives which are extracted
+        """
+        self.scratch = scratch
+        self.max_ratio = max_ratio
+        self.max_total = max_total
+        self.max_members = max_members
+        self.max_depth = max_depth
+        self._handed_out: Dict[Path, int] = {}
+        # Nested archives on disk while their members are extracted
+        self._held = 0
+        self._total = 0
+        self._members = 0
+        # Set while extraction waits for handed out files to be removed
+        self.blocked = asyncio.Event()
+
+    def _copy(
+        self, member: IO[bytes], target: Path, declared: int, progress: _Progress
+    ) -> None:
+        written = 0
+        with open(target, "wb") as out:
+            while chunk := member.read(CHUNK_SIZE):
+                written += len(chunk)
+                progress.extracted += len(chunk)
+                self._total += len(chunk)
+                if written > declared:
+                    raise UnsafeArchive(f"{target.name} is larger than declared")
+                if self._total > self.max_total:
+                    raise UnsafeArchive(f"More than {self.max_total} bytes extracted")
+                if progress.extracted > max(
+                    progress.size * self.max_ratio, RATIO_FLOOR
+                ):
+                    raise UnsafeArchive(
+                        f"Archive expands more than {self.max_ratio} times"
+                    )
+                out.write(chunk)
+
+    async def _room_for(self, size: int) -> bool:
+        """Waits until size bytes fit in the scratch space, False if they never will"""
+        while True:
+            self._handed_out = {
+                file: x for file, x in self._handed_out.items() if file.exists()
+            }
+            if self._held + sum(self._handed_out.values()) + size <= self.scratch:
+                self.blocked.clear()
+                return True
+            if not self._handed_out:
+                self.blocked.clear()
+                return False
+            self.blocked.set()
+            await asyncio.sleep(0.5)
+
+    async def _extract(
+        self, archive: Path, dest: Path, depth: int = 0
+    ) -> AsyncIterator[Path]:
+        progress = _Progress(archive.stat().st_size)
+        declared = await asyncio.to_thread(_declared_size, archive)
+        if declared is not None and declared > max(
+            progress.size * self.max_ratio, RATIO_FLOOR
+        ):
+            raise UnsafeArchive(f"{archive.name} declares {declared} bytes")
+        entries = _entries(archive)
+        try:
+            while (entry := await asyncio.to_thread(next, entries, None)) is not None:
+                name, size, member = entry
+                self._members += 1
+                if self._members > self.max_members:
+                    raise UnsafeArchive(f"More than {self.max_members} members")
+                if (flat := _flat_name(name)) is None:
+                    continue
+                if not await self._room_for(size):
+                    logger.warning(f"Skipping {flat}, {size} bytes exceed the scratch")
+                    continue
+                target = dest / flat
+                if target.exists():
+                    target = dest / f"{uuid4().hex[:8]}_{flat}"
+                try:
+                    await asyncio.to_thread(self._copy, member, target, size, progress)
+                except BaseException:
+                    target.unlink(missing_ok=True)
+                    raise
+                target, sniffed = await asyncio.to_thread(retype, target)
+                if sniffed.kind != "archive":
+                    self._handed_out[target] = target.stat().st_size
+                    yield target
+                    continue
+                if depth >= self.max_depth:
+                    logger.warning(f"Skipping {flat}, archives nest too deep")
+                    target.unlink()
+                    continue
+                nested = target.stat().st_size
+                self._held += nested
+                try:
+                    async for file in self._extract(target, dest, depth + 1):
+                        yield file
+                finally:
+                    self._held -= nested
+                    target.unlink(missing_ok=True)
+        finally:
+            await asyncio.to_thread(entries.close)
+
+    async def stream(self, archive: Path, dest: Path) -> AsyncIterator[Path]:
+        """
+        Extracts the files of archive flat into dest, yielding each once it is written
+
+        Members too large for the scratch space are skipped. Raises UnsafeArchive when
+        a limit is exceeded, the files yielded until then stay valid.
+        """
+        queue: asyncio.Queue[Optional[Path]] = asyncio.Queue()
+
+        async def _produce() -> None:
+            try:
+                async for file in self._extract(archive, dest):
+                    queue.put_nowait(file)
+            finally:
+                queue.put_nowait(None)
+
+        producer = asyncio.create_task(_produce())
+        try:
+            while (file := await queue.get()) is not None:
+                yield file
+            await producer
+        finally:
+            producer.cancel()
+            await asyncio.wait({producer})
+            if not producer.cancelled():
+                producer.exception()
@@ -0,0 +1,153 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from mediamagic.utils.helper import link_file
+
+logger = logging.getLogger("download_cache")
+
+
+class DownloadCache:
+    @dataclasses.dataclass
+    class Entry:
+        blob: str
+        size: int
+        etag: Optional[str] = None
+        last_modified: Optional[str] = None
+        stored_at: float = 0
+        last_used: float = 0
+
+    def __init__(self, root: Path, max_bytes: int, max_age: float = 86400) -> None:
+        """
+        Parameters
+        ----------
+        root : Directory holding the index and the content addressed blobs
+        max_bytes : Byte budget of the blobs, least recently used entries are evicted beyond it
+        max_age : Seconds an entry without ETag/Last-Modified is served without revalidation
+        """
+        self.root = root
+        self.blobs = root / "blobs"
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.index_path = root / "index.json"
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index: Dict[str, DownloadCache.Entry] = {}
+        self._storing: Set[str] = set()
+        try:
+            raw = json.loads(self.index_path.read_text())
+            self.index = {key: self.Entry(**value) for key, value in raw.items()}
+        except (OSError, ValueError, TypeError):
+            pass
+        # Drop entries whose blob vanished underneath us
+        self.index = {
+            key: entry
+            for key, entry in self.index.items()
+            if (self.blobs / entry.blob).is_file()
+        }
+
+    @staticmethod
+    def normalize_url(url: str) -> str:
+        """Returns url with lowercased scheme/host, default port, fragment and query order removed"""
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = (parts.hostname or "").lower()
+        if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+            netloc += f":{parts.port}"
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+    def _save(self) -> None:
+        tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+        tmp.write_text(
+            json.dumps({key: dataclasses.asdict(x) for key, x in self.index.items()})
+        )
+        tmp.replace(self.index_path)
+
+    @property
+    def size(self) -> int:
+        return sum({x.blob: x.size for x in self.index.values()}.values())
+
+    def lookup(self, url: str) -> Optional[Entry]:
+        """Returns the cache entry of url if there is one"""
+        return self.index.get(self.normalize_url(url))
+
+    def is_fresh(self, entry: Entry) -> bool:
+        """Entries without validators are trusted only until max_age"""
+        if entry.etag or entry.last_modified:
+            return True
+        return time.time() - entry.stored_at < self.max_age
+
+    def forget(self, url: str) -> None:
+        if self.index.pop(self.normalize_url(url), None) is not None:
+            self._collect()
+            self._save()
+
+    async def checkout(self, entry: Entry, dest: Path) -> Optional[Path]:
+        """
+        Links the blob of entry to dest and marks it as recently used
+
+        Returns None when the blob can't be read, it may have been collected meanwhile.
+        """
+        try:
+            await asyncio.to_thread(link_file, self.blobs / entry.blob, dest)
+        except OSError as e:
+            logger.warning(f"Unable to check out {entry.blob} {e!r}")
+            return None
+        entry.last_used = time.time()
+        # Eviction after a restart goes by the persisted use times
+        self._save()
+        return dest
+
+    async def store(
+        self,
+        url: str,
+        file: Path,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        """Adds the downloaded file of url to the cache, evicting old entries if needed"""
+        size = file.stat().st_size
+        if size > self.max_bytes:
+            return
+
+        def _digest() -> str:
+            with open(file, "rb") as f:
+                return hashlib.file_digest(f, "sha256").hexdigest()
+
+        digest = await asyncio.to_thread(_digest)
+        blob = self.blobs / digest
+        if not blob.exists():
+            self._storing.add(digest)
+            try:
+                await asyncio.to_thread(link_file, file, blob)
+            finally:
+                self._storing.discard(digest)
+        now = time.time()
+        self.index[self.normalize_url(url)] = self.Entry(
+            digest, size, etag, last_modified, stored_at=now, last_used=now
+        )
+        self.evict()
+        self._save()
+        logger.debug(f"Cached {url} as {digest} {self.size=}")
+
+    def evict(self) -> None:
+        """Drops least recently used entries until the blobs fit in max_bytes"""
+        for key, _ in sorted(self.index.items(), key=lambda x: x[1].last_used):
+            if self.size <= self.max_bytes:
+                break
+            del self.index[key]
+            logger.debug(f"Evicted {key}")
+        self._collect()
+
+    def _collect(self) -> None:
+        """Removes blobs no index entry refers to"""
+        referenced = {x.blob for x in self.index.values()} | self._storing
+        for blob in self.blobs.iterdir():
+            if blob.name not in referenced:
+                blob.unlink(missing_ok=True)
@@ -0,0 +1,122 @@
+import asyncio
+import dataclasses
+import logging
+from typing import Awaitable, Callable, Dict
+
+import disnake
+
+logger = logging.getLogger("filesizelimit")
+
+# Limits discord enforces in Mb, highest first. Guilds below tier 2 still report 25
+# through the api although attachments over 10 are refused there.
+STEPS = (100, 50, 25, 10)
+# Lowest premium tier whose reported limit is enforced as is
+TRUSTED_TIER = 2
+# Bytes a probe exceeds the next lower step by
+PROBE_MARGIN = 1024
+
+
+@dataclasses.dataclass
+class _Limit:
+    mb: int
+    confirmed: bool = False
+    # A probe that failed is not repeated, the limit stays as reported
+    failed: bool = False
+
+
+class FileSizeLimits:
+    """
+    Upload limit of every guild, starting from the one of its premium tier
+
+    The limits of tier 2 and up are taken as reported, lower tiers are confirmed by a
+    message over the next lower step going through. One refused with a 413 lowers the
+    limit to the step below the refused size. Limits only ever step down and are
+    cached until the guild changes.
+    """
+
+    def __init__(self) -> None:
+        self.limits: Dict[int, _Limit] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    def limit(self, guild: disnake.Guild) -> int:
+        """Returns the upload limit of guild in Mb"""
+        if (limit := self.limits.get(guild.id)) is None:
+            limit = _Limit(
+                int(guild.filesize_limit / 1024**2),
+                confirmed=guild.premium_tier >= TRUSTED_TIER,
+            )
+            self.limits[guild.id] = limit
+        return limit.mb
+
+    async def resolve(
+        self, guild: disnake.Guild, probe: Callable[[int], Awaitable[bool]]
+    ) -> int:
+        """
+        Returns the upload limit of guild in Mb, confirmed with probe if not yet
+
+        probe sends a message of the given number of bytes and returns whether it was
+        accepted. Each probe is just over the next lower step, a refused one steps the
+        limit down until one goes through or the lowest step is reached. Concurrent
+        calls for a guild wait for the first one, a failing probe leaves the limit as
+        it is and is not retried until the guild is forgotten.
+        """
+        async with self._locks.setdefault(guild.id, asyncio.Lock()):
+            while True:
+                # Looked up every round, the guild may be forgotten during a probe
+                self.limit(guild)
+                limit = self.limits[guild.id]
+                if limit.confirmed or limit.failed:
+                    return limit.mb
+                lower = next((x for x in STEPS if x < limit.mb), None)
+                if lower is None:
+                    limit.confirmed = True
+                    continue
+                size = lower * 1024**2 + PROBE_MARGIN
+                try:
+                    accepted = await probe(size)
+                except Exception as e:
+                    logger.warning(
+                        f"Probing the upload limit of {guild.id} failed", exc_info=e
+                    )
+                    limit.failed = True
+                    return limit.mb
+                if accepted:
+                    self.accepted(guild.id, size)
+                else:
+                    self.refused(guild.id, size)
+
+    def accepted(self, guild_id: int, size: int) -> None:
+        """Records a message of size bytes sent to guild_id"""
+        limit = self.limits.get(guild_id)
+        if limit is None or limit.confirmed:
+            return
+        lower = next((x for x in STEPS if x < limit.mb), 0)
+        if size > lower * 1024**2:
+            limit.confirmed = True
+            logger.info(f"Upload limit of {guild_id} confirmed at {limit.mb} Mb")
+
+    def refused(self, guild_id: int, size: int) -> None:
+        """Records a message of size bytes refused as too large by guild_id"""
+        limit = self.limits.get(guild_id)
+        if limit is None:
+            return
+        lower = next(
+            (x for x in STEPS if x < limit.mb and x * 1024**2 < size),
+            None,
+        )
+        if lower is None:
+            return
+        logger.warning(
+            f"{guild_id} refused {size / 1024**2:.2f} Mb, "
+            f"lowering its upload limit from {limit.mb} to {lower} Mb"
+        )
+        limit.mb = lower
+        limit.confirmed = False
+
+    def forget(self, guild_id: int) -> None:
+        """Drops the cached limit of guild_id, after its premium tier changed"""
+        self.limits.pop(guild_id, None)
+        self._locks.pop(guild_id, None)
+
+
+file_size_limits = FileSizeLimits()
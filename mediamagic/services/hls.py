@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from collections import deque
+from pathlib import Path
+from typing import Deque
+
+import aiofiles
+import httpx
+import m3u8
+from ffmpeg.asyncio import FFmpeg
+
+from mediamagic.exceptions import UnsupportedPlaylist
+from mediamagic.services.scheduler import media_scheduler
+
+logger = logging.getLogger("hls")
+
+
+class HLSDownloader:
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        concurrency: int = 8,
+        user_agent: str = "Magic Browser",
+        max_retries: int = 3,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        client : The http client used for playlists and segments
+        concurrency : Maximum number of segments fetched at the same time
+        user_agent : User-Agent sent with every request
+        max_retries : Number of times a failed segment is refetched
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self.headers = {"User-Agent": user_agent}
+        self.max_retries = max_retries
+
+    async def _get(self, url: str) -> bytes:
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = await self.client.get(
+                    url, headers=self.headers, follow_redirects=True
+                )
+                resp.raise_for_status()
+                return resp.content
+            except httpx.HTTPError as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.debug(f"Refetching {url} {e!r}")
+                await asyncio.sleep(2**attempt)
+        raise AssertionError("unreachable")
+
+    async def media_playlist(self, url: str) -> m3u8.M3U8:
+        """Returns the media playlist of url, picking the highest bandwidth variant"""
+        playlist = m3u8.loads((await self._get(url)).decode(), uri=url)
+        if playlist.is_variant:
+            variant = max(
+                playlist.playlists, key=lambda x: x.stream_info.bandwidth or 0
+            )
+            logger.debug(f"Selected variant {variant.absolute_uri}")
+            playlist = m3u8.loads(
+                (await self._get(variant.absolute_uri)).decode(),
+                uri=variant.absolute_uri,
+            )
+        if not playlist.is_endlist:
+            raise UnsupportedPlaylist(f"{url} is a live playlist")
+        if any(key and key.method not in (None, "NONE") for key in playlist.keys):
+            raise UnsupportedPlaylist(f"{url} has encrypted segments")
+        if not playlist.segments:
+            raise UnsupportedPlaylist(f"{url} has no segments")
+        # Segments would be fetched whole, ffmpeg honours the ranges
+        if any(
+            x.byterange or (x.init_section and x.init_section.byterange)
+            for x in playlist.segments
+        ):
+            raise UnsupportedPlaylist(f"{url} addresses segments by byte range")
+        return playlist
+
+    async def fetch(self, playlist: m3u8.M3U8, out: Path) -> None:
+        """Fetches the segments of playlist concurrently and writes them in order to out"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _fetch(uri: str) -> bytes:
+            async with semaphore:
+                return await self._get(uri)
+
+        uris = []
+        init_section = None
+        for segment in playlist.segments:
+            # fMP4 playlists prepend their init section once
+            section = segment.init_section
+            if section and section.absolute_uri != init_section:
+                init_section = section.absolute_uri
+                uris.append(init_section)
+            uris.append(segment.absolute_uri)
+
+        # Only a window of segments is held in memory while waiting for the writer
+        window: Deque[asyncio.Task] = deque()
+        try:
+            async with aiofiles.open(out, mode="wb") as file:
+                for uri in uris:
+                    window.append(asyncio.create_task(_fetch(uri)))
+                    if len(window) >= self.concurrency * 2:
+                        await file.write(await window.popleft())
+                while window:
+                    await file.write(await window.popleft())
+        finally:
+            for task in window:
+                task.cancel()
+
+    async def remux(self, stream: Path, out: Path) -> None:
+        """Stream copies the concatenated segments into an mp4 container"""
+        ffmpeg = FFmpeg().option("y").input(str(stream)).output(str(out), codec="copy")
+        async with media_scheduler.job("ffmpeg"):
+            await ffmpeg.execute()
+
+    async def download(self, url: str, out: Path) -> Path:
+        """Downloads the m3u8 url into out as mp4"""
+        playlist = await self.media_playlist(url)
+        stream = out.with_suffix(".ts")
+        logger.debug(f"Fetching {len(playlist.segments)} segments of {url}")
+        try:
+            await self.fetch(playlist, stream)
+            await self.remux(stream, out)
+        finally:
+            stream.unlink(missing_ok=True)
+        return out
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    from mediamagic.services.adownloader import Adownloader
+
+    async def main():
+        parser = argparse.ArgumentParser(
+            usage=f"{sys.argv[0]} <url1> <url2> ...",
+            description="Compares native HLS fetching against the ffmpeg input path",
+        )
+        parser.add_argument("urls", nargs="+", help="m3u8 links to download")
+        parser.add_argument("--concurrency", type=int, default=8)
+        args = parser.parse_args()
+        out_dir = Path("hls_benchmark")
+        out_dir.mkdir(exist_ok=True)
+
+        async with httpx.AsyncClient(
+            timeout=httpx.Timeout(None),
+            limits=httpx.Limits(max_connections=args.concurrency),
+        ) as client:
+            for url in args.urls:
+                for name in ("ffmpeg", "native"):
+                    out = out_dir / f"{name}.mp4"
+                    start = time.perf_counter()
+                    if name == "native":
+                        await HLSDownloader(client, args.concurrency).download(url, out)
+                    else:
+                        await Adownloader(set())._ffmpeg_m3u8(url, out)
+                    elapsed = time.perf_counter() - start
+                    size = out.stat().st_size / 1024**2
+                    print(
+                        f"{name:>6}: {size:.2f} MB in {elapsed:.2f}s "
+                        f"({size / elapsed:.2f} MB/s) {url}"
+                    )
+                    out.unlink()
+        out_dir.rmdir()
+
+    asyncio.run(main())
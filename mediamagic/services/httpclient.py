@@ -0,0 +1,298 @@
+import asyncio
+import dataclasses
+import importlib.util
+import logging
+import time
+from typing import AsyncIterator, Callable, Dict, Optional, Set
+
+import httpx
+
+from mediamagic.constants import HttpPolicy
+
+logger = logging.getLogger("httpclient")
+
+
+def http2_available() -> bool:
+    """HTTP/2 support of httpx needs the optional h2 package"""
+    return importlib.util.find_spec("h2") is not None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        """
+        Parameters
+        ----------
+        rate : Tokens added per second
+        burst : Maximum number of tokens held at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Waits until a token is available and takes it"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclasses.dataclass(frozen=True)
+class HostLimit:
+    concurrency: Optional[int] = None
+    rate: Optional[float] = None
+    burst: int = 1
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Response body which gives back its host slot once closed"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable) -> None:
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+class Http2FallbackTransport(httpx.AsyncBaseTransport):
+    """Multiplexes over HTTP/2 and sticks to HTTP/1.1 for hosts where it failed"""
+
+    def __init__(
+        self, http2: httpx.AsyncBaseTransport, http1: httpx.AsyncBaseTransport
+    ) -> None:
+        self.http2 = http2
+        self.http1 = http1
+        self.http1_hosts: Set[str] = set()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        if host not in self.http1_hosts:
+            try:
+                return await self.http2.handle_async_request(request)
+            except (httpx.RemoteProtocolError, httpx.LocalProtocolError) as e:
+                logger.warning(f"HTTP/2 failed for {host}, using HTTP/1.1: {e!r}")
+                self.http1_hosts.add(host)
+        return await self.http1.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self.http2.aclose()
+        await self.http1.aclose()
+
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    """Transport enforcing per host concurrency caps and token bucket rate limits"""
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        limits: Dict[str, HostLimit],
+        default: HostLimit,
+        semaphores: Optional[Dict[str, asyncio.Semaphore]] = None,
+        buckets: Optional[Dict[str, TokenBucket]] = None,
+        streams: Optional[int] = None,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        transport : The transport doing the actual requests
+        limits : Limits of hosts and parent domains
+        default : Limit of hosts not in limits
+        semaphores : Host slots, passed to share them between transports
+        buckets : Host token buckets, passed to share them between transports
+        streams : Concurrent requests to a host not in limits which answers over
+            HTTP/2, they share a connection instead of opening one each
+        """
+        self.transport = transport
+        self.limits = limits
+        self.default = default
+        self.semaphores = {} if semaphores is None else semaphores
+        self.buckets = {} if buckets is None else buckets
+        self.streams = streams
+        # HTTP version every host last answered with
+        self.protocols: Dict[str, str] = {}
+        self.learning: Dict[str, asyncio.Event] = {}
+        self.closed = False
+
+    def _configured(self, host: str) -> Optional[HostLimit]:
+        parts = host.split(".")
+        for i in range(len(parts)):
+            if (limit := self.limits.get(".".join(parts[i:]))) is not None:
+                return limit
+        return None
+
+    def limit_for(self, host: str) -> HostLimit:
+        """Returns the limit of host or of the closest parent domain configured"""
+        if (limit := self._configured(host)) is not None:
+            return limit
+        if self.streams and self.protocols.get(host) == "HTTP/2":
+            return dataclasses.replace(self.default, concurrency=self.streams)
+        return self.default
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        if not self.streams or self._configured(host) is not None:
+            return await self._send(request)
+        # The first request to a host finds out whether it multiplexes, the ones
+        # arriving meanwhile wait for it instead of queueing for the default cap
+        while host not in self.protocols and (event := self.learning.get(host)):
+            await event.wait()
+        learning = None
+        if host not in self.protocols:
+            learning = self.learning[host] = asyncio.Event()
+        try:
+            response = await self._send(request)
+            # A host falling back to HTTP/1.1 goes back to the default cap
+            http_version = response.extensions.get("http_version", b"HTTP/1.1")
+            self.protocols[host] = http_version.decode()
+            return response
+        finally:
+            if learning is not None:
+                del self.learning[host]
+                learning.set()
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        limit = self.limit_for(host)
+        if limit.rate:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(limit.rate, limit.burst)
+            await self.buckets[host].acquire()
+        if not limit.concurrency:
+            return await self.transport.handle_async_request(request)
+
+        # Keyed by the cap as well, multiplexed hosts don't share the slots of
+        # HTTP/1.1 transports
+        slot = f"{host}:{limit.concurrency}"
+        if slot not in self.semaphores:
+            self.semaphores[slot] = asyncio.Semaphore(limit.concurrency)
+        semaphore = self.semaphores[slot]
+        await semaphore.acquire()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        assert isinstance(response.stream, httpx.AsyncByteStream)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, semaphore.release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        if not self.closed:
+            self.closed = True
+            await self.transport.aclose()
+
+
+class HttpClientManager:
+    """Bot wide http clients sharing one connection pool and per host limits"""
+
+    def __init__(
+        self,
+        limits: Dict[str, HostLimit],
+        default: HostLimit,
+        pool: httpx.Limits = httpx.Limits(
+            max_connections=100, max_keepalive_connections=20, keepalive_expiry=30
+        ),
+        streams: Optional[int] = None,
+    ) -> None:
+        self.limits = limits
+        self.default = default
+        self.pool = pool
+        # Per host cap of the HTTP/2 transport for hosts which multiplex
+        self.streams = streams
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.buckets: Dict[str, TokenBucket] = {}
+        self._transports: Dict[bool, HostLimitedTransport] = {}
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def transport(self, http2: bool = False) -> HostLimitedTransport:
+        """Returns the shared transport, HTTP/2 falls back to HTTP/1.1 without h2"""
+        if http2 and not http2_available():
+            logger.warning("h2 isn't installed, HTTP/2 falls back to HTTP/1.1")
+            http2 = False
+        transport = self._transports.get(http2)
+        if transport is None or transport.closed:
+            inner: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(
+                limits=self.pool, retries=1
+            )
+            if http2:
+                inner = Http2FallbackTransport(
+                    httpx.AsyncHTTPTransport(limits=self.pool, retries=1, http2=True),
+                    inner,
+                )
+            transport = HostLimitedTransport(
+                inner,
+                self.limits,
+                self.default,
+                self.semaphores,
+                self.buckets,
+                streams=self.streams if http2 else None,
+            )
+            self._transports[http2] = transport
+        return transport
+
+    def _client(
+        self, name: str, timeout: httpx.Timeout, http2: bool = False
+    ) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                transport=self.transport(http2),
+                timeout=timeout,
+                follow_redirects=True,
+            )
+            self._clients[name] = client
+        return client
+
+    @property
+    def api(self) -> httpx.AsyncClient:
+        """Client for small api calls, with the default timeouts"""
+        return self._client("api", httpx.Timeout(10))
+
+    @property
+    def download(self) -> httpx.AsyncClient:
+        """Client for transfers of unbounded length"""
+        return self._client("download", httpx.Timeout(None))
+
+    @property
+    def download_h2(self) -> httpx.AsyncClient:
+        """Client for transfers multiplexed over HTTP/2 where the server supports it"""
+        return self._client("download_h2", httpx.Timeout(None), http2=True)
+
+    async def aclose(self) -> None:
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        for transport in self._transports.values():
+            await transport.aclose()
+        self._transports.clear()
+
+
+http_manager = HttpClientManager(
+    {host: HostLimit(*value) for host, value in HttpPolicy.hosts.items()},
+    HostLimit(*HttpPolicy.default),
+    streams=HttpPolicy.http2_streams,
+)
@@ -0,0 +1,144 @@
+import logging
+from pathlib import Path
+from typing import Optional
+
+from ffmpeg import FFmpegError
+from ffmpeg.asyncio import FFmpeg
+
+from mediamagic.services.scheduler import media_scheduler
+from mediamagic.services.videosegmenter import VidSegmenter
+from mediamagic.utils.sniff import sniff_file
+
+logger = logging.getLogger("imageopt")
+
+# Downscale factors tried in order, each with every quality step
+SCALES = (1.0, 0.7, 0.5, 0.35, 0.25)
+# mjpeg qscale (lower is better) and libwebp quality (higher is better)
+JPEG_QUALITY = (3, 6, 10)
+WEBP_QUALITY = (85, 70, 50)
+# Pixel formats carrying transparency, palettes may have transparent entries
+ALPHA_PIX_FMTS = {
+    "rgba",
+    "bgra",
+    "argb",
+    "abgr",
+    "ya8",
+    "ya16le",
+    "ya16be",
+    "rgba64le",
+    "rgba64be",
+    "bgra64le",
+    "bgra64be",
+    "gbrap",
+    "gbrap16le",
+    "gbrap16be",
+    "yuva420p",
+    "yuva422p",
+    "yuva444p",
+    "pal8",
+}
+
+
+class ImageOptimizer:
+    def __init__(self, max_size: int) -> None:
+        """
+        Parameters
+        ----------
+        max_size : Size in Mb the output has to fit in
+        """
+        self.max_size = max_size
+
+    def _fits(self, file: Path) -> bool:
+        return file.stat().st_size / 1024**2 < self.max_size
+
+    async def _encode(self, ffmpeg: FFmpeg) -> bool:
+        try:
+            async with media_scheduler.job("ffmpeg"):
+                await ffmpeg.execute()
+        except FFmpegError as e:
+            logger.debug(f"Encode failed {e.message}")
+            return False
+        return True
+
+    async def gif_to_mp4(self, file: Path) -> Optional[Path]:
+        """Converts an animated GIF to H.264, usually a tenth of the size"""
+        out = file.with_suffix(".mp4")
+        ffmpeg = (
+            FFmpeg()
+            .option("y")
+            .input(str(file))
+            .output(
+                str(out),
+                {"c:v": "libx264"},
+                movflags="+faststart",
+                pix_fmt="yuv420p",
+                # yuv420p needs even dimensions
+                vf="scale=trunc(iw/2)*2:trunc(ih/2)*2",
+                crf=23,
+                an=None,
+            )
+        )
+        if not await self._encode(ffmpeg):
+            out.unlink(missing_ok=True)
+            return None
+        return out
+
+    async def recompress(self, file: Path) -> Optional[Path]:
+        """
+        Re-encodes a still image, downscaling step by step until it fits
+
+        Images with an alpha channel become WebP to keep transparency, the others JPEG
+        """
+        info = await VidSegmenter(self.max_size).probe(file)
+        stream = (info.streams or [{}])[0]
+        alpha = stream.get("pix_fmt") in ALPHA_PIX_FMTS
+        out = file.with_name(f"{file.stem}.opt{'.webp' if alpha else '.jpg'}")
+        qualities = WEBP_QUALITY if alpha else JPEG_QUALITY
+        for scale in SCALES:
+            for quality in qualities:
+                options = (
+                    {"c:v": "libwebp", "quality": quality}
+                    if alpha
+                    else {"q:v": quality, "pix_fmt": "yuvj444p"}
+                )
+                ffmpeg = (
+                    FFmpeg()
+                    .option("y")
+                    .input(str(file))
+                    .output(
+                        str(out),
+                        options,
+                        vf=f"scale=trunc(iw*{scale}/2)*2:-2",
+                        frames="1",
+                    )
+                )
+                if not await self._encode(ffmpeg):
+                    # A smaller scale or another quality may still encode
+                    out.unlink(missing_ok=True)
+                    continue
+                if self._fits(out):
+                    logger.debug(f"{file.name} fits at {scale=} {quality=}")
+                    return out
+        out.unlink(missing_ok=True)
+        return None
+
+    async def optimize(self, file: Path) -> Optional[Path]:
+        """
+        Returns a smaller replacement of the oversized image file, None if none fits
+
+        GIFs come back as mp4, which may still need segmenting
+        """
+        sniffed = sniff_file(file)
+        if sniffed.ext == ".gif":
+            out = await self.gif_to_mp4(file)
+        else:
+            out = await self.recompress(file)
+        if out is None:
+            logger.warning(f"Unable to optimize {file.name}")
+            return None
+        logger.info(
+            f"Optimized {file.name} {file.stat().st_size / 1024**2:.2f} Mb "
+            f"to {out.name} {out.stat().st_size / 1024**2:.2f} Mb"
+        )
+        file.unlink()
+        return out
@@ -0,0 +1,49 @@
+import dataclasses
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("probecache")
+
+# (device, inode, size, mtime_ns), changes whenever the file is rewritten or replaced
+FileIdentity = Tuple[int, int, int, int]
+
+
+@dataclasses.dataclass
+class MediaInfo:
+    """What is known about one version of a media file, filled in lazily by the probes"""
+
+    duration: Optional[float] = None
+    bit_rate: Optional[int] = None
+    streams: Optional[List[Dict[str, Any]]] = None
+    healthy: Optional[bool] = None
+    keyframes: Optional[Tuple[List[Tuple[float, int]], int]] = None
+
+
+class ProbeCache:
+    """Least recently used probe results keyed by file identity"""
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.entries: OrderedDict[FileIdentity, MediaInfo] = OrderedDict()
+
+    @staticmethod
+    def identity(file: Path) -> FileIdentity:
+        stat = file.stat()
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, file: Path) -> MediaInfo:
+        """Returns the entry of the current version of file, creating an empty one"""
+        key = self.identity(file)
+        info = self.entries.get(key)
+        if info is None:
+            info = self.entries[key] = MediaInfo()
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return info
+
+
+probe_cache = ProbeCache()
@@ -0,0 +1,162 @@
+import asyncio
+import contextlib
+import contextvars
+import dataclasses
+import enum
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, Iterator, Optional
+
+from mediamagic.constants import Client
+
+logger = logging.getLogger("scheduler")
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+@dataclasses.dataclass(frozen=True)
+class JobContext:
+    """Who a media job runs for, inherited by every task spawned within the context"""
+
+    owner: Optional[int] = None
+    priority: Priority = Priority.BULK
+
+
+job_context: contextvars.ContextVar[JobContext] = contextvars.ContextVar(
+    "media_job", default=JobContext()
+)
+
+
+@contextlib.contextmanager
+def media_context(
+    owner: Optional[int], priority: Priority = Priority.BULK
+) -> Iterator[None]:
+    """Attributes media jobs started within the block to owner, usually a guild id"""
+    token = job_context.set(JobContext(owner, priority))
+    try:
+        yield
+    finally:
+        job_context.reset(token)
+
+
+class _Pool:
+    def __init__(self, slots: int) -> None:
+        self.slots = slots
+        self.running = 0
+        # Per priority, owners in round robin order with their waiters
+        self.queues: Dict[
+            Priority, OrderedDict[Optional[int], Deque[asyncio.Future]]
+        ] = {priority: OrderedDict() for priority in Priority}
+        self.admitted = 0
+        self.max_queued = 0
+        self.wait_time = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(x) for queue in self.queues.values() for x in queue.values())
+
+
+class MediaScheduler:
+    """
+    Process wide admission of media subprocesses
+
+    Every kind of job has its own slot count. Waiting jobs are admitted by priority
+    and round robin between owners of the same priority, so one guild's bulk upload
+    can't starve the others.
+    """
+
+    def __init__(self, slots: Dict[str, int]) -> None:
+        """
+        Parameters
+        ----------
+        slots : Concurrent jobs allowed per kind of job
+        """
+        self.pools = {kind: _Pool(max(1, count)) for kind, count in slots.items()}
+
+    def _dispatch(self, pool: _Pool) -> None:
+        """Hands free slots to the next waiters"""
+        for priority in Priority:
+            queue = pool.queues[priority]
+            while queue and pool.running < pool.slots:
+                owner, waiters = next(iter(queue.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    queue.move_to_end(owner)
+                else:
+                    del queue[owner]
+                if not waiter.done():
+                    waiter.set_result(None)
+                    pool.running += 1
+
+    async def _acquire(self, pool: _Pool, context: JobContext) -> None:
+        if pool.running < pool.slots and not pool.queued:
+            pool.running += 1
+            pool.admitted += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        queue = pool.queues[context.priority]
+        queue.setdefault(context.owner, deque()).append(waiter)
+        pool.max_queued = max(pool.max_queued, pool.queued)
+        start = time.perf_counter()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over right before the cancellation
+                self._release(pool)
+            elif waiter in (waiters := queue.get(context.owner, ())):
+                waiters.remove(waiter)
+                if not waiters:
+                    del queue[context.owner]
+            raise
+        pool.admitted += 1
+        pool.wait_time += time.perf_counter() - start
+
+    def _release(self, pool: _Pool) -> None:
+        pool.running -= 1
+        self._dispatch(pool)
+
+    @contextlib.asynccontextmanager
+    async def job(self, kind: str) -> AsyncIterator[None]:
+        """Holds a slot of kind for the duration of the block"""
+        pool = self.pools[kind]
+        await self._acquire(pool, job_context.get())
+        try:
+            yield
+        finally:
+            self._release(pool)
+
+    def report(self) -> None:
+        """Logs slot usage and queue depth of every kind of job"""
+        for kind, pool in self.pools.items():
+            logger.info(
+                f"{kind} jobs: {pool.running}/{pool.slots} running, "
+                f"{pool.queued} queued (at most {pool.max_queued}), "
+                f"{pool.admitted} admitted after waiting {pool.wait_time:.2f}s"
+            )
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """Slot usage and queue depth of every kind of job"""
+        return {
+            kind: {
+                "slots": pool.slots,
+                "running": pool.running,
+                "queued": pool.queued,
+                "queued_interactive": sum(
+                    len(x) for x in pool.queues[Priority.INTERACTIVE].values()
+                ),
+                "max_queued": pool.max_queued,
+                "admitted": pool.admitted,
+                "wait_time": round(pool.wait_time, 3),
+            }
+            for kind, pool in self.pools.items()
+        }
+
+
+media_scheduler = MediaScheduler(
+    {"probe": Client.probe_jobs, "ffmpeg": Client.ffmpeg_jobs}
+)
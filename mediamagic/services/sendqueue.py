@@ -0,0 +1,99 @@
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import time
+from typing import AsyncIterator, Dict
+
+from mediamagic.constants import Client
+
+logger = logging.getLogger("sendqueue")
+
+
+@dataclasses.dataclass
+class ChannelStats:
+    messages: int = 0
+    bytes: int = 0
+    # Seconds spent sending and waiting for the channel or a slot
+    busy: float = 0.0
+    waited: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Uploaded Mb per second of sending"""
+        return self.bytes / 1024**2 / self.busy if self.busy else 0.0
+
+
+class SendQueue:
+    """
+    Process wide ordering of message sends
+
+    Sends to the same channel run one at a time in call order, sends to different
+    channels run in parallel, at most slots at once. The rate limit buckets of every
+    route are honoured by the disnake http client, keeping one send in flight per
+    channel stops a channel from queueing up behind its own bucket.
+    """
+
+    @dataclasses.dataclass
+    class Lane:
+        lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
+        users: int = 0
+
+    def __init__(self, slots: int) -> None:
+        """
+        Parameters
+        ----------
+        slots : Sends in flight at once over all channels
+        """
+        self.slots = asyncio.Semaphore(max(1, slots))
+        self.lanes: Dict[int, SendQueue.Lane] = {}
+        self.stats: Dict[int, ChannelStats] = {}
+
+    @contextlib.asynccontextmanager
+    async def send(self, channel_id: int, size: int) -> AsyncIterator[None]:
+        """Holds the turn of channel_id for a message of size bytes during the block"""
+        lane = self.lanes.setdefault(channel_id, self.Lane())
+        stats = self.stats.setdefault(channel_id, ChannelStats())
+        lane.users += 1
+        queued = time.perf_counter()
+        try:
+            async with lane.lock, self.slots:
+                start = time.perf_counter()
+                stats.waited += start - queued
+                try:
+                    yield
+                finally:
+                    stats.busy += time.perf_counter() - start
+                stats.messages += 1
+                stats.bytes += size
+        finally:
+            lane.users -= 1
+            if not lane.users:
+                del self.lanes[channel_id]
+
+    def report(self, channel_id: int) -> None:
+        """Logs the upload throughput of a channel"""
+        if (stats := self.stats.get(channel_id)) is None:
+            return
+        logger.info(
+            f"Channel {channel_id}: {stats.messages} messages "
+            f"{stats.bytes / 1024**2:.2f} Mb in {stats.busy:.2f}s "
+            f"({stats.throughput:.2f} Mb/s, waited {stats.waited:.2f}s)"
+        )
+
+    def metrics(self) -> Dict[int, Dict[str, float]]:
+        """Messages, volume and throughput of every channel sent to"""
+        return {
+            channel_id: {
+                "messages": stats.messages,
+                "mb": round(stats.bytes / 1024**2, 2),
+                "busy": round(stats.busy, 3),
+                "waited": round(stats.waited, 3),
+                "throughput": round(stats.throughput, 2),
+                "in_flight": channel_id in self.lanes,
+            }
+            for channel_id, stats in self.stats.items()
+        }
+
+
+send_queue = SendQueue(Client.upload_jobs)
@@ -0,0 +1,106 @@
+import asyncio
+import dataclasses
+import errno
+import logging
+import shutil
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+from uuid import NAMESPACE_URL, uuid5
+
+from mediamagic.constants import Client
+from mediamagic.utils.helper import link_file
+
+logger = logging.getLogger("singleflight")
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Process wide registry letting concurrent requesters of a resource share one transfer"""
+
+    @dataclasses.dataclass
+    class Flight:
+        task: asyncio.Task
+        staging: Path
+        waiters: int = 0
+        # Waiters which took their file already and the links they are making
+        served: int = 0
+        links: List[asyncio.Future] = dataclasses.field(default_factory=list)
+
+    def __init__(self, staging: Path) -> None:
+        self.staging = staging
+        self.flights: Dict[str, SingleFlight.Flight] = {}
+
+    async def do(
+        self,
+        key: str,
+        fetch: Callable[[Path], Awaitable[Optional[Tuple[Path, T]]]],
+        dest: Path,
+    ) -> Optional[Tuple[Path, T]]:
+        """
+        Runs fetch for key unless it is already in flight and places its result in dest
+
+        fetch receives a staging directory and returns the file it produced there along
+        with its metadata. It must not depend on the requester which started it, every
+        requester gets its own file inside dest and the same metadata. The last one
+        served gets the staged file itself, the others a link of it.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            # Stable staging directory so resumable downloads survive restarts
+            staging = self.staging / str(uuid5(NAMESPACE_URL, key))
+            staging.mkdir(parents=True, exist_ok=True)
+            flight = self.Flight(asyncio.create_task(fetch(staging)), staging)
+            self.flights[key] = flight
+        else:
+            logger.info(f"Joining in-flight download of {key}")
+        flight.waiters += 1
+        try:
+            # Shielded so a cancelled requester doesn't abort the others
+            result = await asyncio.shield(flight.task)
+            if result is None:
+                return None
+            staged, meta = result
+            file = dest / staged.name
+            flight.served += 1
+            if flight.served < flight.waiters:
+                link = asyncio.ensure_future(asyncio.to_thread(link_file, staged, file))
+                flight.links.append(link)
+                await asyncio.shield(link)
+                return file, meta
+            # Nobody else waits, the flight is closed before the file moves out
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if flight.links:
+                await asyncio.wait(flight.links)
+            try:
+                staged.replace(file)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                await asyncio.to_thread(link_file, staged, file)
+            return file, meta
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0:
+                await self._land(key, flight)
+
+    async def _land(self, key: str, flight: Flight) -> None:
+        """Drops a flight nobody waits for anymore along with its staging directory"""
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if not flight.task.done():
+            flight.task.cancel()
+            await asyncio.wait({flight.task})
+            if key in self.flights:
+                # A new flight took over the staging directory meanwhile
+                return
+        failed = flight.task.cancelled() or flight.task.exception() is not None
+        if failed or flight.task.result() is None:
+            # Keep the journal of an interrupted resumable download around
+            if any(flight.staging.glob("*.journal")):
+                return
+        shutil.rmtree(flight.staging, ignore_errors=True)
+
+
+shared_flights = SingleFlight(Path(Client.staging_dir))
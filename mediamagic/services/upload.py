@@ -1,7 +1,21 @@
+import asyncio
+import io
 import logging
-from functools import partial
+from collections import deque
 from pathlib import Path
-from typing import Iterable, List, Optional, Set, Union
+from typing import (
+    AsyncGenerator,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 from uuid import uuid4
 from zipfile import BadZipfile, ZipFile
 
@@ -9,11 +23,22 @@ import aioshutil
 import disnake
 from disnake.ext import commands
 
+from mediamagic.constants import Client
+from mediamagic.services.archive import ArchiveExtractor
+from mediamagic.services.filesizelimit import file_size_limits
+from mediamagic.services.imageopt import ImageOptimizer
+from mediamagic.services.scheduler import media_scheduler
+from mediamagic.services.sendqueue import send_queue
 from mediamagic.services.videosegmenter import VidSegmenter
 from mediamagic.utils.helper import move_files_to_root
+from mediamagic.utils.packing import first_fit_decreasing, next_fit
+from mediamagic.utils.sniff import retype, sniff_file
 
 logger = logging.getLogger("upload_service")
 
+# Kept free in every message for the multipart encoding around the attachments
+MESSAGE_OVERHEAD = 64 * 1024
+
 
 class UploadService:
     async def upload_file(
@@ -24,6 +49,8 @@ class UploadService:
         channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
     ) -> None:
         try:
+            if sniff_file(file).kind not in ("video", "audio"):
+                raise ValueError(f"{file} is not segmentable")
             segmenter = VidSegmenter(max_file_size)
             dir = await segmenter.segment(file, Path("."))
             await self.upload(inter, dir, max_file_size, channel)
@@ -63,17 +90,24 @@ class UploadService:
         max_file_size: int,
         channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
     ) -> None:
-        zip_path = Path(str(uuid4()))
+        """Uploads the members of every archive while they are being extracted"""
         for file in zip_files:
+            zip_path = Path(str(uuid4()))
+            zip_path.mkdir()
+            extractor = ArchiveExtractor()
             try:
-                await aioshutil.unpack_archive(file, zip_path)
-                file.unlink()
-                move_files_to_root(zip_path)
-                await self.upload(inter, zip_path, max_file_size, channel)
+                await self.upload_stream(
+                    inter,
+                    extractor.stream(file, zip_path),
+                    zip_path,
+                    max_file_size,
+                    channel,
+                    flush_now=extractor.blocked,
+                )
             except Exception as e:
                 logger.error("Bad Zip File!", exc_info=e)
-                file.unlink()
-                await aioshutil.rmtree(zip_path)
+            finally:
+                file.unlink(missing_ok=True)
 
     async def upload_segment(
         self,
@@ -84,14 +118,88 @@ class UploadService:
         channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
     ) -> None:
         logger.info(f"{len(to_segment)} files found which are more than 25mb detected")
-        for file in to_segment:
-            try:
-                segmenter = VidSegmenter(max_file_size)
-                seg_dir = await segmenter.segment(file, dir)
-            except Exception:
-                continue
+        pending = iter(sorted(to_segment))
+
+        async def _segment(file: Path) -> Path:
+            seg_dir = await VidSegmenter(max_file_size).segment(file, dir)
+            # The pieces replace the source on disk right away, not after their upload
             file.unlink()
-            await self.upload(inter, seg_dir, max_file_size, channel)
+            return seg_dir
+
+        # A few files are segmented ahead of the upload, which follows the file order
+        window: Deque[Tuple[Path, asyncio.Task]] = deque()
+
+        def _refill() -> None:
+            while len(window) < max(1, Client.segment_ahead):
+                if (file := next(pending, None)) is None:
+                    return
+                window.append((file, asyncio.ensure_future(_segment(file))))
+
+        try:
+            _refill()
+            while window:
+                file, task = window.popleft()
+                try:
+                    seg_dir = await task
+                except Exception as e:
+                    logger.error(f"Unable to segment {file.name}", exc_info=e)
+                    continue
+                finally:
+                    _refill()
+                await self.upload(inter, seg_dir, max_file_size, channel, ordered=True)
+        finally:
+            for _, task in window:
+                task.cancel()
+            await asyncio.gather(*(x for _, x in window), return_exceptions=True)
+
+    @staticmethod
+    def _is_local_index(file: Path) -> bool:
+        """Whether the playlist file only lists segments lying next to it"""
+        if file.stat().st_size > 1024**2:
+            return False
+        uris = [
+            line.strip()
+            for line in file.read_text(errors="replace").splitlines()
+            if line.strip() and not line.startswith("#")
+        ]
+        return bool(uris) and all(
+            "/" not in uri and file.with_name(uri).is_file() for uri in uris
+        )
+
+    def _route(
+        self, file: Path, max_file_size: int
+    ) -> Tuple[Literal["archive", "segment", "optimize", "send", "drop"], Path]:
+        """Picks the upload path of file from its sniffed type, fixing its extension"""
+        file, sniffed = retype(file)
+        if sniffed.kind == "reject":
+            logger.warning(f"Dropping {file.name}, it is not media")
+            return "drop", file
+        if sniffed.kind == "archive":
+            return "archive", file
+        if sniffed.ext == ".m3u8":
+            if self._is_local_index(file):
+                # Sorts after the numbered segments, so it's posted after them
+                return "send", file
+            # Its segments are fetched by the downloader, the index alone is useless
+            logger.warning(f"Dropping {file.name}, it is a playlist")
+            return "drop", file
+        if file.stat().st_size / 1024**2 <= max_file_size:
+            return "send", file
+        if sniffed.kind in ("video", "audio"):
+            return "segment", file
+        if sniffed.kind == "image":
+            return "optimize", file
+        logger.warning(f"Dropping {file.name}, {sniffed.kind} files can't be split")
+        return "drop", file
+
+    async def _optimize(
+        self, file: Path, max_file_size: int
+    ) -> Tuple[Literal["archive", "segment", "optimize", "send", "drop"], Path]:
+        """Shrinks an oversized image and routes the result like any other file"""
+        optimized = await ImageOptimizer(max_file_size).optimize(file)
+        if optimized is None:
+            return "drop", file
+        return self._route(optimized, max_file_size)
 
     async def upload(
         self,
@@ -99,28 +207,37 @@ class UploadService:
         dir: Path,
         max_file_size: int,
         channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
+        ordered: bool = False,
     ) -> None:
-        """Generic Function for upload"""
-        max_file_size = 10  # discord api didn't updated file size limit on api
+        """
+        Generic Function for upload
+
+        Files of an ordered directory, like the pieces of a segmented video, keep their
+        name order across messages, the others are packed into as few messages as fit.
+        """
         logger.debug(f"Upload started {dir=} {max_file_size=}")
         if dir.is_file():
             logger.debug(f"Uploading file {dir=} {max_file_size=}")
             await self.upload_file(inter, dir, max_file_size, channel)
         else:
-            dir_iter = {x for x in map(lambda x: Path(x), dir.iterdir()) if x.is_file()}
-            zip_files = {i for i in dir_iter if str(i).endswith(".zip")}
-            to_segment = {
-                file
-                for file in dir_iter
-                if file.stat().st_size / 1024**2 > max_file_size
+            routes: Dict[str, Set[Path]] = {
+                "archive": set(),
+                "segment": set(),
+                "optimize": set(),
+                "send": set(),
+                "drop": set(),
             }
-            dir_iter = dir_iter - zip_files
-            dir_iter = sorted(dir_iter - to_segment)
-            total_file = [file for file in map(lambda x: disnake.File(x), dir_iter)]
-            file_grps = [
-                total_file[i : i + 8] for i in range(0, len(total_file), 8)
-            ]  # Legacy way to batch
-            # file_grps = batched(total_file, 8)
+            for file in dir.iterdir():
+                if file.is_file():
+                    route, file = self._route(file, max_file_size)
+                    routes[route].add(file)
+            # Oversized images are shrunk concurrently, GIFs come back as video
+            for route, file in await asyncio.gather(
+                *(self._optimize(x, max_file_size) for x in routes["optimize"])
+            ):
+                routes[route].add(file)
+            zip_files = routes["archive"]
+            to_segment = routes["segment"]
 
             if zip_files:
                 logger.debug(f"Uploading zip {zip_files=} {max_file_size=}")
@@ -135,21 +252,243 @@ class UploadService:
                 )
 
             logger.debug(f"Uploading to {channel=}")
-            for file_grp in file_grps:
-                len_file = [x.bytes_length / 1024**2 for x in file_grp]
+            failed = await self.send_files(
+                inter, sorted(routes["send"]), max_file_size, channel, ordered
+            )
+            await self._resend_smaller(inter, failed, max_file_size, channel, ordered)
+
+            await aioshutil.rmtree(dir)
+
+    @staticmethod
+    def _destination(
+        inter: Union[disnake.Interaction, commands.Context],
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]],
+    ) -> Union[disnake.TextChannel, disnake.Thread, disnake.abc.Messageable]:
+        """Resolves where files for channel are sent to"""
+        if isinstance(channel, disnake.ThreadWithMessage):
+            return channel.thread
+        if isinstance(channel, disnake.TextChannel):
+            return channel
+        return inter.channel
+
+    async def send(
+        self,
+        inter: Union[disnake.Interaction, commands.Context],
+        file_grp: List[Path],
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
+    ) -> bool:
+        """
+        Sends a group of files in a single message, False if it was refused as too large
+
+        Messages to one channel go out in call order, other channels don't wait on it.
+        The files are only opened once it is their turn and closed right after. Any
+        other failure is raised.
+        """
+        len_file = [x.stat().st_size / 1024**2 for x in file_grp]
+        size = sum(x.stat().st_size for x in file_grp)
+        target = self._destination(inter, channel)
+        guild = getattr(target, "guild", None)
+        try:
+            logger.debug(f"Uploading {sum(len_file)}")
+            async with send_queue.send(target.id, size):
+                files = []
                 try:
-                    logger.debug(f"Uploading {sum(len_file)}")
-                    if isinstance(channel, disnake.ThreadWithMessage):
-                        send = partial(channel.thread.send, files=file_grp)
-                    elif isinstance(channel, disnake.TextChannel):
-                        send = partial(channel.send, files=file_grp)
-                    else:
-                        send = partial(inter.channel.send, files=file_grp)
-                    await send()
-                except Exception as e:
-                    logger.error(
-                        f"Upload Failed {e} {
-                            sum(len_file)} {len_file=}"
-                    )
+                    files.extend(disnake.File(x) for x in file_grp)
+                    await target.send(files=files)
+                finally:
+                    for file in files:
+                        file.close()
+        except Exception as e:
+            logger.error(
+                f"Upload Failed {e} {
+                    sum(len_file)} {len_file=}"
+            )
+            if not isinstance(e, disnake.HTTPException) or e.status != 413:
+                raise
+            if guild:
+                file_size_limits.refused(guild.id, size)
+            return False
+        if guild:
+            file_size_limits.accepted(guild.id, size)
+        return True
 
+    async def probe_limit(
+        self,
+        inter: Union[disnake.Interaction, commands.Context],
+        size: int,
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
+    ) -> bool:
+        """
+        Sends a throwaway attachment of size bytes, returns whether it was accepted
+
+        The message is deleted right away, a refusal other than 413 is raised.
+        """
+        target = self._destination(inter, channel)
+        async with send_queue.send(target.id, size):
+            probe = disnake.File(io.BytesIO(bytes(size)), "limit-probe.bin")
+            try:
+                msg = await target.send(files=[probe])
+            except disnake.HTTPException as e:
+                if e.status == 413:
+                    return False
+                raise
+            finally:
+                probe.close()
+        await msg.delete()
+        return True
+
+    async def send_files(
+        self,
+        inter: Union[disnake.Interaction, commands.Context],
+        files: List[Path],
+        max_file_size: int,
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
+        ordered: bool = False,
+    ) -> List[Path]:
+        """
+        Sends files in as few messages as the attachment count and size limits allow
+
+        Ordered files are packed in sequence, the others largest first. A message
+        refused as too large is retried file by file, so one oversized file doesn't
+        take its group down. Returns the files refused as too large.
+        """
+        pack = next_fit if ordered else first_fit_decreasing
+        groups = pack(
+            files,
+            lambda x: x.stat().st_size,
+            Client.attachments_per_message,
+            max_file_size * 1024**2 - MESSAGE_OVERHEAD,
+        )
+        logger.debug(f"Packed {len(files)} files into {len(groups)} messages")
+        failed: List[Path] = []
+        for group in groups:
+            if await self.send(inter, group, channel):
+                continue
+            if len(group) == 1:
+                failed.extend(group)
+                continue
+            logger.info(f"Retrying {len(group)} files one by one")
+            for file in group:
+                if not await self.send(inter, [file], channel):
+                    failed.append(file)
+        return failed
+
+    async def _resend_smaller(
+        self,
+        inter: Union[disnake.Interaction, commands.Context],
+        files: List[Path],
+        max_file_size: int,
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
+        ordered: bool = False,
+    ) -> int:
+        """
+        Uploads files refused for their size again once the guild limit was lowered
+
+        Returns the limit to continue with.
+        """
+        guild = getattr(self._destination(inter, channel), "guild", None)
+        if not files or guild is None:
+            return max_file_size
+        if (limit := file_size_limits.limit(guild)) >= max_file_size:
+            return max_file_size
+        oversized = [x for x in files if x.stat().st_size / 1024**2 > limit]
+        if oversized:
+            logger.info(f"Uploading {len(oversized)} files again within {limit} Mb")
+            retry = Path(str(uuid4()))
+            retry.mkdir()
+            for file in oversized:
+                file.rename(retry / file.name)
+            await self.upload(inter, retry, limit, channel, ordered)
+        return limit
+
+    async def upload_stream(
+        self,
+        inter: Union[disnake.Interaction, commands.Context],
+        files: AsyncGenerator[Path, None],
+        dir: Path,
+        max_file_size: int,
+        channel: Optional[Union[disnake.TextChannel, disnake.ThreadWithMessage]] = None,
+        flush_after: float = 5,
+        expected_size: Optional[Callable[[Path], Optional[int]]] = None,
+        flush_now: Optional[asyncio.Event] = None,
+    ) -> None:
+        """
+        Uploads files as soon as they are yielded instead of waiting for the whole directory
+
+        Small files are batched in arrival order into messages as full as the attachment
+        count and size limits allow, a partial batch is sent once no new file arrived
+        for flush_after seconds or once flush_now is set, when the producer waits for the
+        batched files to be removed. Files smaller than expected_size reports
+        are truncated downloads and get dropped.
+        """
+        logger.debug(f"Stream upload started {dir=} {max_file_size=}")
+        batch: List[Path] = []
+        batch_size = 0
+
+        async def _flush() -> None:
+            nonlocal batch_size, max_file_size
+            if batch:
+                failed = await self.send_files(
+                    inter, batch, max_file_size, channel, ordered=True
+                )
+                # Later files are routed within a limit lowered by a refusal
+                max_file_size = await self._resend_smaller(
+                    inter, failed, max_file_size, channel, ordered=True
+                )
+                batch_size = 0
+                for file in batch:
+                    file.unlink(missing_ok=True)
+                batch.clear()
+
+        pending: Optional[asyncio.Future] = None
+        try:
+            while True:
+                # Asking for the next file lets the producer start another download
+                pending = asyncio.ensure_future(anext(files, None))
+                if batch:
+                    waits = {pending}
+                    if flush_now is not None:
+                        waits.add(asyncio.ensure_future(flush_now.wait()))
+                    done, _ = await asyncio.wait(
+                        waits, timeout=flush_after, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for waiter in waits - {pending}:
+                        waiter.cancel()
+                    if pending not in done:
+                        await _flush()
+                if (file := await pending) is None:
+                    break
+                size = file.stat().st_size
+                if expected_size and (expected := expected_size(file)):
+                    if size < expected:
+                        logger.error(f"Dropping truncated {file} {size=} {expected=}")
+                        file.unlink()
+                        continue
+                route, file = self._route(file, max_file_size)
+                if route == "optimize":
+                    route, file = await self._optimize(file, max_file_size)
+                if route == "drop":
+                    file.unlink()
+                elif route == "archive":
+                    await self.upload_zip(inter, [file], max_file_size, channel)
+                elif route == "segment":
+                    await self.upload_segment(
+                        inter, [file], dir, max_file_size, channel
+                    )
+                else:
+                    size = file.stat().st_size
+                    if batch_size + size > max_file_size * 1024**2 - MESSAGE_OVERHEAD:
+                        await _flush()
+                    batch.append(file)
+                    batch_size += size
+                    if len(batch) == Client.attachments_per_message:
+                        await _flush()
+            await _flush()
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+                await asyncio.wait({pending})
+            await files.aclose()
             await aioshutil.rmtree(dir)
+            send_queue.report(self._destination(inter, channel).id)
+            media_scheduler.report()
@@ -1,54 +1,265 @@
 import asyncio
+import contextlib
+import glob
+import json
 import logging
+import math
+import shutil
 from pathlib import Path
-from typing import List, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
+from ffmpeg import FFmpegError
 from ffmpeg.asyncio import FFmpeg
 
-from mediamagic.constants import BinPath
+from mediamagic.constants import BinPath, Client, Transcode
+from mediamagic.services.probecache import MediaInfo, probe_cache
+from mediamagic.services.scheduler import media_scheduler
 
 logger = logging.getLogger("videosegmenter")
 
+# Streams every output container takes, subtitles, attachments and data streams of
+# mkv and ts inputs don't fit in mp4 and ts pieces
+AV_STREAMS = ["0:v?", "0:a?"]
+
 
 class VidSegmenter:
 
-    def __init__(self, max_size: int):
+    def __init__(
+        self,
+        max_size: int,
+        engine: Optional[str] = None,
+        transcode: Optional[str] = None,
+    ):
         self.max_size = max_size
-
-    async def get_video_duration_size(self, video_path: Path) -> Tuple[float, float]:
-        """Returns tuple of duration(seconds) & size(mb) of a video."""
+        self.engine = engine or Client.segment_engine
+        self.transcode = transcode or Transcode.mode
+
+    async def probe(self, media: Path) -> MediaInfo:
+        """Returns duration, bitrate and stream layout of media, probing it only once"""
+        info = probe_cache.get(media)
+        if info.streams is not None:
+            return info
         command = [
             "ffprobe",
             "-v",
             "error",
             "-show_entries",
-            "format=duration",
+            "format=duration,bit_rate:stream=index,codec_type,codec_name,width,height,"
+            "avg_frame_rate,pix_fmt,bit_rate",
             "-of",
-            "default=noprint_wrappers=1:nokey=1",
-            str(video_path),
+            "json",
+            str(media),
         ]
 
-        process = await asyncio.create_subprocess_exec(
-            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
+        async with media_scheduler.job("probe"):
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await process.communicate()
 
-        if process.returncode == 0:
-            duration = float(stdout)
-            return duration, video_path.stat().st_size / (1024**2)
-        else:
+        if process.returncode != 0:
             raise RuntimeError(
                 f"Error getting video duration for {
-                    video_path}: {stderr.decode()}"
+                    media}: {stderr.decode()}"
             )
+        data = json.loads(stdout)
+        fmt = data.get("format", {})
+        with contextlib.suppress(KeyError, ValueError):
+            info.duration = float(fmt["duration"])
+        with contextlib.suppress(KeyError, ValueError):
+            info.bit_rate = int(fmt["bit_rate"])
+        info.streams = data.get("streams", [])
+        return info
 
-    async def trim_hls(
-        self, media: Path, segment_duration: float, out_dir: Path
-    ) -> List:
-        # todo: figure out the way to trim rescursive and generate m3u8 file referencing following command
-        #  ffmpeg -i input.mp4 -c copy -f hls -hls_time 100 -reset_timestamps 1 -hls_list_size 0 -hls_segment_filename output/hi%03d.mp4 output/inp%03d.m3u8
+    async def get_video_duration_size(self, video_path: Path) -> Tuple[float, float]:
+        """Returns tuple of duration(seconds) & size(mb) of a video."""
+        info = await self.probe(video_path)
+        if info.duration is None:
+            raise ValueError(f"{video_path} has no known duration")
+        return info.duration, video_path.stat().st_size / (1024**2)
+
+    async def timestamps_healthy(self, media: Path, packets: int = 500) -> bool:
+        """
+        Checks the leading packets of media for missing or non monotonic timestamps
+
+        Only the first packets and the container header are read, media without a
+        known duration counts as unhealthy as well.
+        """
+        info = probe_cache.get(media)
+        if info.healthy is not None:
+            return info.healthy
+        command = [
+            "ffprobe",
+            "-v",
+            "error",
+            "-read_intervals",
+            f"%+#{packets}",
+            "-show_entries",
+            "format=duration:packet=stream_index,pts,dts",
+            "-of",
+            "csv=p=1",
+            str(media),
+        ]
+        async with media_scheduler.job("probe"):
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            stdout, _ = await process.communicate()
+        if process.returncode != 0:
+            info.healthy = False
+            return False
+        has_duration = False
+        last_dts: Dict[str, int] = {}
+        for line in stdout.decode().splitlines():
+            fields = line.split(",")
+            if fields[0] == "format":
+                has_duration = fields[1] not in ("", "N/A")
+            elif fields[0] == "packet" and len(fields) >= 4:
+                stream, pts, dts = fields[1:4]
+                if "N/A" in (pts, dts) or int(dts) < last_dts.get(stream, int(dts)):
+                    info.healthy = False
+                    return False
+                last_dts[stream] = int(dts)
+        info.healthy = has_duration
+        return has_duration
+
+    async def keyframe_index(self, media: Path) -> Tuple[List[Tuple[float, int]], int]:
+        """
+        Reads every packet header of media in a single ffprobe pass
+
+        Returns the cut candidates as (seconds from start, bytes before it) along
+        with the total payload size. Candidates are the keyframes of the video
+        stream, or of every stream for audio only files.
+        """
+        info = probe_cache.get(media)
+        if info.keyframes is not None:
+            return info.keyframes
+        command = [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=start_time:packet=codec_type,pts_time,dts_time,size,flags",
+            "-of",
+            "csv=p=0",
+            str(media),
+        ]
+        async with media_scheduler.job("probe"):
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"Error reading packets of {media}: {stderr.decode()}")
+
+        def _parse() -> Tuple[List[Tuple[float, int]], int]:
+            keyframes: List[Tuple[str, float, int]] = []
+            start = None
+            start_time = None
+            total = 0
+            for line in stdout.decode().splitlines():
+                fields = line.split(",")
+                if len(fields) == 1:
+                    # The container start time, priming packets may precede it
+                    with contextlib.suppress(ValueError):
+                        start_time = float(fields[0])
+                    continue
+                if len(fields) < 5 or not fields[3].isdigit():
+                    continue
+                codec_type, pts_time, dts_time, size, flags = fields[:5]
+                time = pts_time if pts_time != "N/A" else dts_time
+                if time == "N/A":
+                    total += int(size)
+                    continue
+                seconds = float(time)
+                start = seconds if start is None else min(start, seconds)
+                if "K" in flags:
+                    keyframes.append((codec_type, seconds, total))
+                total += int(size)
+            has_video = any(x[0] == "video" for x in keyframes)
+            start = start_time if start_time is not None else start
+            index = [
+                (seconds - (start or 0), before)
+                for codec_type, seconds, before in keyframes
+                if codec_type == "video" or not has_video
+            ]
+            return sorted(index), total
+
+        info.keyframes = await asyncio.to_thread(_parse)
+        return info.keyframes
+
+    def plan_cuts(
+        self, index: List[Tuple[float, int]], total: int, headroom: float = 0.97
+    ) -> List[float]:
+        """
+        Greedily picks the last keyframe keeping each piece under max_size
+
+        A keyframe interval larger than the budget can't be split by stream copy,
+        the piece is then cut at the next keyframe and left oversized.
+        """
+        # Head room for the container index and headers of each piece
+        budget = self.max_size * 1024**2 * headroom - 64 * 1024
+        cuts: List[float] = []
+        forced = 0
+        piece_start = 0
+        last_fit: Optional[Tuple[float, int]] = None
+        # The end of the file closes the last piece but is no cut candidate
+        for seconds, before in [*index, (math.inf, total)]:
+            if seconds <= 0:
+                continue
+            while before - piece_start > budget:
+                if last_fit is not None:
+                    cut, last_fit = last_fit, None
+                elif seconds != math.inf:
+                    forced += 1
+                    cut = (seconds, before)
+                else:
+                    break
+                cuts.append(cut[0])
+                piece_start = cut[1]
+                if cut[0] == seconds:
+                    break
+            if not cuts or seconds > cuts[-1]:
+                last_fit = (seconds, before)
+        if forced:
+            logger.warning(f"{forced} keyframe intervals over {self.max_size} Mb")
+        return cuts
 
-        raise NotImplementedError
+    async def trim_hls(
+        self,
+        media: Path,
+        cuts: List[float],
+        out_dir: Path,
+        delta: float = 0,
+        fix_timestamps: bool = False,
+    ) -> Path:
+        """
+        Cuts media at cuts into MPEG-TS segments plus their index.m3u8 in one stream
+        copy pass
+
+        Timestamps stay continuous across segments so the playlist plays back
+        seamlessly, every segment plays standalone as well.
+        """
+        playlist = out_dir / "index.m3u8"
+        ffmpeg = (
+            FFmpeg()
+            .option("y")
+            .input(str(media), {"fflags": "+genpts"} if fix_timestamps else {})
+            .output(
+                str(out_dir / "%03d.ts"),
+                codec="copy",
+                map=AV_STREAMS,
+                f="segment",
+                segment_format="mpegts",
+                segment_times=",".join(f"{x:.6f}" for x in cuts),
+                segment_time_delta=f"{delta:.6f}",
+                segment_list=str(playlist),
+                segment_list_type="m3u8",
+            )
+        )
+        async with media_scheduler.job("ffmpeg"):
+            await ffmpeg.execute()
+        return playlist
 
     async def trim(
         self,
@@ -77,7 +288,8 @@ class VidSegmenter:
         )
 
         try:
-            await ffmpeg.execute()
+            async with media_scheduler.job("ffmpeg"):
+                await ffmpeg.execute()
         except Exception as e:
             logger.error(f"Error trimming {media.name}", exc_info=e)
             return
@@ -85,26 +297,35 @@ class VidSegmenter:
 
     async def ensure_segments_size(self, outdir: Path, retry: int = 0) -> None:
         """Ensures that all segments are less than the max_size using recursive trimming."""
-        should_check = False
-        files = [file for file in outdir.iterdir() if file.is_file()]
-        for file in files:
+
+        async def _ensure(file: Path) -> bool:
+            if file.stat().st_size / 1024**2 < self.max_size:
+                return False
             segment_duration, size = await self.get_video_duration_size(file)
             # Both segment_duration returns same amount of file but just there
             # is imbalance in the size of the file in the first var
 
             # segment_duration = (segment_duration / size) * (self.max_size - 1)
             segment_duration = segment_duration / 2
+            await self.trim(
+                media=file,
+                segment_duration=segment_duration,
+                out_path=outdir,
+                file_name=f"{file.name}-%03d.mp4",
+            )
+            pieces = list(outdir.glob(f"{glob.escape(file.name)}-*.mp4"))
+            if len(pieces) < 2:
+                # A single keyframe interval can't be split by stream copy, keep it
+                logger.warning(f"Unable to split {file.name} below {self.max_size} Mb")
+                for piece in pieces:
+                    piece.unlink()
+                return False
+            file.unlink()
+            return True
 
-            if size >= self.max_size:
-                should_check = True
-                await self.trim(
-                    media=file,
-                    segment_duration=segment_duration,
-                    out_path=outdir,
-                    file_name=f"{file.name}-%03d.mp4",
-                )
-                file.unlink()
-        if should_check:
+        files = [file for file in outdir.iterdir() if file.is_file()]
+        # Oversized pieces are probed and trimmed concurrently, bounded by the slots
+        if any(await asyncio.gather(*map(_ensure, files))):
             logger.debug(f"Retrying {retry}")
             retry = retry + 1
             await self.ensure_segments_size(outdir, retry)
@@ -121,7 +342,8 @@ class VidSegmenter:
             )
         )
         try:
-            await ffmpeg.execute()
+            async with media_scheduler.job("ffmpeg"):
+                await ffmpeg.execute()
         except Exception as e:
             logger.error(f"Error while sanitizing {media.name}", exc_info=e)
             return
@@ -129,15 +351,120 @@ class VidSegmenter:
         Path(str(media) + ".mp4").rename(str(media))
 
     async def segment(self, media: Path, save_dir: Path) -> Path:
-        """Wrapper for segment method, where versions can be changed manually"""
-        # res = await self.segment_v1(media, save_dir)
-        res = await self.segment_v2(media, save_dir)
+        """Wrapper for segment method, the version is picked by the engine setting"""
+        engines = {
+            "v1": self.segment_v1,
+            "v2": self.segment_v2,
+            "v3": self.segment_v3,
+            "v4": self.segment_v4,
+            "hls": self.segment_hls,
+        }
+        if self.transcode != "off":
+            plan = await self.transcode_plan(media)
+            if plan is not None:
+                return await self.segment_transcode(media, save_dir, *plan)
+        res = await engines[self.engine](media, save_dir)
         return res
 
+    async def transcode_plan(self, media: Path) -> Optional[Tuple[float, int]]:
+        """
+        Decides between stream copy and transcoding by estimated time until uploaded
+
+        Copying costs the upload of every byte plus one message per piece.
+        Transcoding costs the encode, estimated from the preset speed scaled by
+        resolution, plus the upload of the fewest pieces whose bitrate stays above
+        min_bpp. Returns the piece duration and video bitrate of the transcode, or
+        None when copying is faster.
+        """
+        info = await self.probe(media)
+        video = next(
+            (x for x in info.streams or () if x.get("codec_type") == "video"), None
+        )
+        if video is None or not info.duration or not video.get("width"):
+            return None
+        num, _, den = video.get("avg_frame_rate", "30/1").partition("/")
+        fps = float(num) / float(den or 1) if float(den or 1) else 30.0
+        pixels = video["width"] * video["height"]
+        has_audio = any(x.get("codec_type") == "audio" for x in info.streams or ())
+        audio = Transcode.audio_bitrate if has_audio else 0
+
+        size = media.stat().st_size
+        budget = self.max_size * 1024**2 * 0.92
+        copy_pieces = math.ceil(size / budget)
+        copy_time = (
+            size / Transcode.upload_bandwidth + copy_pieces * Transcode.message_cost
+        )
+
+        floor = Transcode.min_bpp * pixels * (fps or 30)
+        for pieces in range(1, copy_pieces):
+            piece_time = info.duration / pieces
+            # One second of rate control buffer may spill over each piece
+            bitrate = int(budget * 8 / (piece_time + 1) - audio)
+            if bitrate >= floor:
+                break
+        else:
+            return None
+        encode_time = info.duration / (
+            Transcode.speed * (1920 * 1080 * 30) / (pixels * (fps or 30))
+        )
+        transcode_time = (
+            encode_time
+            + pieces * budget / Transcode.upload_bandwidth
+            + pieces * Transcode.message_cost
+        )
+        logger.debug(
+            f"{media.name}: copy {copy_pieces} pieces ~{copy_time:.0f}s, "
+            f"transcode {pieces} pieces at {bitrate / 1000:.0f} kbps ~{transcode_time:.0f}s"
+        )
+        if self.transcode == "always" or transcode_time < copy_time:
+            return piece_time, bitrate
+        return None
+
+    async def segment_transcode(
+        self, media: Path, save_dir: Path, piece_time: float, bitrate: int
+    ) -> Path:
+        """Re-encodes a video at bitrate, keyframes forced at every piece boundary"""
+
+        out_path = save_dir / media.stem
+        out_path.mkdir(parents=True, exist_ok=True)
+        ffmpeg = (
+            FFmpeg()
+            .option("y")
+            .input(str(media))
+            .output(
+                str(out_path / "%03d.mp4"),
+                {
+                    "map": ["0:v:0", "0:a:0?"],
+                    "c:v": "libx264",
+                    "b:v": bitrate,
+                    "maxrate": bitrate,
+                    "bufsize": bitrate,
+                    "c:a": "aac",
+                    "b:a": Transcode.audio_bitrate,
+                },
+                preset=Transcode.preset,
+                threads=0,
+                pix_fmt="yuv420p",
+                force_key_frames=f"expr:gte(t,n_forced*{piece_time:.6f})",
+                f="segment",
+                segment_time=f"{piece_time:.6f}",
+                reset_timestamps="1",
+            )
+        )
+        logger.debug(f"Transcoding {media.name} at {bitrate / 1000:.0f} kbps")
+        async with media_scheduler.job("ffmpeg"):
+            await ffmpeg.execute()
+
+        if any(x.stat().st_size / 1024**2 >= self.max_size for x in out_path.iterdir()):
+            await self.ensure_segments_size(out_path)
+        return out_path
+
     async def segment_v1(self, media: Path, save_dir: Path) -> Path:
         """Segments a video file into smaller parts."""
 
-        await self.sanitize_video(media)
+        # The duration based plan needs a container duration, only a remux fixes it
+        if not await self.timestamps_healthy(media):
+            await self.sanitize_video(media)
         duration, size = await self.get_video_duration_size(media)
         segment_duration = (duration / size) * self.max_size
 
@@ -164,19 +491,285 @@ class VidSegmenter:
 
     async def segment_v2(self, media: Path, save_dir: Path) -> Path:
 
-        await self.sanitize_video(media)
+        if not await self.timestamps_healthy(media):
+            await self.sanitize_video(media)
         out_path = save_dir / media.stem
 
         out_path.mkdir(parents=True, exist_ok=True)
-        process = await asyncio.create_subprocess_exec(
-            BinPath.segmenter,
-            media,
-            out_path,
-            str(int(self.max_size)),
+        async with media_scheduler.job("ffmpeg"):
+            process = await asyncio.create_subprocess_exec(
+                BinPath.segmenter,
+                media,
+                out_path,
+                str(int(self.max_size)),
+            )
+            await process.communicate()
+        return out_path
+
+    async def plan(
+        self, media: Path, headroom: float = 0.97
+    ) -> Tuple[List[float], float, bool]:
+        """
+        Plans the keyframe cuts of media for the single pass engines
+
+        Returns the cut times, the start time tolerance of the segment muxer and
+        whether the timestamps of media are healthy.
+        """
+        healthy = await self.timestamps_healthy(media)
+        size = media.stat().st_size / 1024**2
+        if size <= self.max_size:
+            raise ValueError(f"Video Size is Already less than {self.max_size} Mb")
+        index, total = await self.keyframe_index(media)
+        if not index and not healthy:
+            # No timestamps to plan with at all, only a remux generates them
+            await self.sanitize_video(media)
+            index, total = await self.keyframe_index(media)
+            healthy = True
+        cuts = self.plan_cuts(index, total, headroom)
+        if not cuts:
+            raise ValueError(f"No keyframe to cut {media.name} at")
+        # Tolerates a shifted start time without reaching the previous keyframe
+        gaps = [b[0] - a[0] for a, b in zip(index, index[1:]) if b[0] > a[0]]
+        delta = min(0.5, min(gaps) / 2) if gaps else 0
+        logger.debug(f"Cutting {media.name} {size=:.2f} Mb into {len(cuts) + 1} pieces")
+        return cuts, delta, healthy
+
+    async def segment_v3(self, media: Path, save_dir: Path) -> Path:
+        """Segments a video in a single stream copy pass at cuts planned from keyframes"""
+
+        cuts, delta, healthy = await self.plan(media)
+        out_path = save_dir / media.stem
+        out_path.mkdir(parents=True, exist_ok=True)
+        ext = media.suffix if media.suffix in (".mp4", ".mov", ".webm") else ".mp4"
+        # Broken timestamps are regenerated by the segmenting pass itself
+        fix = {} if healthy else {"fflags": "+genpts"}
+        ffmpeg = (
+            FFmpeg()
+            .option("y")
+            .input(str(media), fix)
+            .output(
+                str(out_path / f"%03d{ext}"),
+                {} if healthy else {"avoid_negative_ts": "make_zero"},
+                codec="copy",
+                map=AV_STREAMS,
+                f="segment",
+                segment_times=",".join(f"{x:.6f}" for x in cuts),
+                segment_time_delta=f"{delta:.6f}",
+                reset_timestamps="1",
+            )
         )
-        await process.communicate()
+        async with media_scheduler.job("ffmpeg"):
+            await ffmpeg.execute()
+
+        # Only a keyframe interval over the budget leaves a piece too large
+        if any(x.stat().st_size / 1024**2 >= self.max_size for x in out_path.iterdir()):
+            logger.debug(f"Ensuring segments are less than {self.max_size} Mb")
+            await self.ensure_segments_size(out_path)
+        return out_path
+
+    async def segment_v4(self, media: Path, save_dir: Path) -> Path:
+        """
+        Segments a video by copying the planned pieces concurrently, one ffmpeg each
+
+        Trades one sequential pass for parallel seeks, the pieces are the same as
+        segment_v3. Broken timestamps can't be seeked reliably and go through v3.
+        """
+
+        cuts, delta, healthy = await self.plan(media)
+        if not healthy:
+            return await self.segment_v3(media, save_dir)
+        out_path = save_dir / media.stem
+        out_path.mkdir(parents=True, exist_ok=True)
+        ext = media.suffix if media.suffix in (".mp4", ".mov", ".webm") else ".mp4"
+
+        async def _piece(idx: int, start: float, end: Optional[float]) -> None:
+            # Input seeking snaps back to the keyframe the cut was planned at and
+            # reading stops right before the keyframe of the next piece
+            bounds = {"ss": f"{start + delta / 2:.6f}"} if start else {}
+            if end is not None:
+                bounds["to"] = f"{end - 0.001:.6f}"
+            ffmpeg = (
+                FFmpeg()
+                .option("y")
+                .input(str(media), bounds)
+                .output(
+                    str(out_path / f"{idx:03d}{ext}"),
+                    codec="copy",
+                    map=AV_STREAMS,
+                    avoid_negative_ts="make_zero",
+                )
+            )
+            async with media_scheduler.job("ffmpeg"):
+                try:
+                    await ffmpeg.execute()
+                except asyncio.CancelledError:
+                    # execute leaves the process running when it is cancelled
+                    with contextlib.suppress(FFmpegError):
+                        ffmpeg.terminate()
+                    raise
+
+        starts = [0.0, *cuts]
+        ends: List[Optional[float]] = [*cuts, None]
+        try:
+            # A failing piece cancels its siblings
+            async with asyncio.TaskGroup() as tg:
+                for idx, (start, end) in enumerate(zip(starts, ends)):
+                    tg.create_task(_piece(idx, start, end))
+        except BaseException:
+            # The pieces written so far would pass for a complete result
+            shutil.rmtree(out_path, ignore_errors=True)
+            raise
+
+        if any(x.stat().st_size / 1024**2 >= self.max_size for x in out_path.iterdir()):
+            logger.debug(f"Ensuring segments are less than {self.max_size} Mb")
+            await self.ensure_segments_size(out_path)
         return out_path
 
+    async def segment_hls(self, media: Path, save_dir: Path) -> Path:
+        """Segments a video into HLS parts and their index.m3u8, cut like segment_v3"""
+
+        # MPEG-TS packetisation adds a few percent over the mp4 payload
+        cuts, delta, healthy = await self.plan(media, headroom=0.9)
+        out_path = save_dir / media.stem
+        out_path.mkdir(parents=True, exist_ok=True)
+        await self.trim_hls(media, cuts, out_path, delta, fix_timestamps=not healthy)
+        return out_path
+
+    async def head_probe(self, head: bytes) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Probes the first bytes of a video
+
+        Returns the duration the container announces upfront and the longest keyframe
+        interval within head, each None if unknown.
+        """
+        command = [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "format=duration:packet=pts_time,flags",
+            "-of",
+            "csv=p=0",
+            "-i",
+            "pipe:0",
+        ]
+        async with media_scheduler.job("probe"):
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, _ = await process.communicate(head)
+        duration: Optional[float] = None
+        keyframes: List[float] = []
+        # Packet lines are pts_time,flags, the format section is the duration alone
+        for line in stdout.decode().splitlines():
+            fields = line.split(",")
+            with contextlib.suppress(ValueError):
+                if len(fields) == 1:
+                    duration = float(fields[0]) or None
+                elif "K" in fields[1]:
+                    keyframes.append(float(fields[0]))
+        keyframes.sort()
+        interval = max((b - a for a, b in zip(keyframes, keyframes[1:])), default=None)
+        return duration, interval
+
+    async def segment_stream(
+        self, body: AsyncIterator[bytes], out: Path, ext: str, piece_time: float
+    ) -> AsyncIterator[Path]:
+        """
+        Segments a video read from body, yielding every piece as soon as it is complete
+
+        Pieces are named out_000ext, out_001ext... and cut at the first keyframe after
+        every piece_time seconds. Only containers readable front to back can be piped.
+        Raises when ffmpeg or body fail, the unfinished piece is not yielded then.
+        """
+        command = [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-v",
+            "error",
+            "-y",
+            "-fflags",
+            "+genpts",
+            "-i",
+            "pipe:0",
+            # Subtitle and attachment streams of mkv don't fit in mp4
+            "-map",
+            "0:v?",
+            "-map",
+            "0:a?",
+            "-c",
+            "copy",
+            "-avoid_negative_ts",
+            "make_zero",
+            "-f",
+            "segment",
+            "-segment_time",
+            f"{piece_time:.3f}",
+            "-reset_timestamps",
+            "1",
+            # A piece is listed once ffmpeg closed it
+            "-segment_list",
+            "pipe:1",
+            "-segment_list_type",
+            "flat",
+            f"{out}_%03d{ext}",
+        ]
+        # Paced by the download rather than the CPU, so it doesn't take an ffmpeg slot
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        assert process.stdin is not None
+        assert process.stdout is not None and process.stderr is not None
+        stdin = process.stdin
+
+        async def _feed() -> None:
+            try:
+                async for chunk in body:
+                    stdin.write(chunk)
+                    await stdin.drain()
+            except BaseException:
+                # Closing stdin would let ffmpeg list the unfinished piece as complete
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                raise
+            finally:
+                stdin.close()
+
+        feeder = asyncio.create_task(_feed())
+        errors = asyncio.create_task(process.stderr.read())
+        try:
+            async for line in process.stdout:
+                if name := line.decode(errors="replace").strip():
+                    yield out.parent / name
+            await process.wait()
+            if process.returncode != 0:
+                if feeder.done():
+                    # ffmpeg was killed because the body broke off
+                    await feeder
+                stderr = (await errors).decode(errors="replace").strip()
+                raise RuntimeError(f"Segmenting {out.name} failed: {stderr[-500:]}")
+            # Also raises when the download broke off, ffmpeg only saw an early end
+            await feeder
+        finally:
+            for task in (feeder, errors):
+                task.cancel()
+            await asyncio.wait({feeder, errors})
+            if not feeder.cancelled():
+                # Already surfaced through the exit code of ffmpeg
+                feeder.exception()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
 
 async def main():
     input_file = Path("o.mp4")
@@ -1,5 +1,11 @@
+import errno
+import fcntl
+import os
+import shutil
 from pathlib import Path
 
+FICLONE = 0x40049409  # linux/fs.h, copy-on-write clone of a whole file
+
 
 def move_files_to_root(root_dir_path):
     root_dir = Path(root_dir_path)
@@ -14,3 +20,31 @@ def move_files_to_root(root_dir_path):
                 item.rmdir()
 
     move_files(root_dir)
+
+
+def link_file(source: Path, dest: Path) -> None:
+    """
+    Places source at dest without copying data when the filesystem allows it
+
+    A copy-on-write clone is preferred, then a hardlink, a copy is the last resort.
+    Linked files share their data, they are replaced and never written in place.
+    """
+    try:
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except OSError as e:
+        dest.unlink(missing_ok=True)
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+            raise
+    try:
+        os.link(source, dest)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+            raise
+    try:
+        shutil.copyfile(source, dest)
+    except OSError:
+        dest.unlink(missing_ok=True)
+        raise
@@ -0,0 +1,43 @@
+from typing import Callable, List, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+def first_fit_decreasing(
+    items: Sequence[T], size: Callable[[T], int], max_count: int, max_bytes: int
+) -> List[List[T]]:
+    """
+    Packs items into as few bins as possible, at most max_count items and max_bytes each
+
+    Items are placed largest first into the first bin with room left. An item larger
+    than max_bytes gets a bin of its own.
+    """
+    bins: List[List[T]] = []
+    free: List[int] = []
+    for item in sorted(items, key=size, reverse=True):
+        weight = size(item)
+        for idx, room in enumerate(free):
+            if weight <= room and len(bins[idx]) < max_count:
+                bins[idx].append(item)
+                free[idx] -= weight
+                break
+        else:
+            bins.append([item])
+            free.append(max_bytes - weight)
+    return bins
+
+
+def next_fit(
+    items: Sequence[T], size: Callable[[T], int], max_count: int, max_bytes: int
+) -> List[List[T]]:
+    """Packs items in their order, a bin is closed as soon as the next item doesn't fit"""
+    bins: List[List[T]] = []
+    room = 0
+    for item in items:
+        weight = size(item)
+        if not bins or weight > room or len(bins[-1]) >= max_count:
+            bins.append([])
+            room = max_bytes
+        bins[-1].append(item)
+        room -= weight
+    return bins
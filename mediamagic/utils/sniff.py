@@ -0,0 +1,148 @@
+import bz2
+import dataclasses
+import lzma
+import zlib
+from pathlib import Path
+from typing import Literal, Optional, Tuple
+
+# Enough for every signature below, including the tar magic behind a compressed header
+SNIFF_SIZE = 4096
+# MPEG-TS packets, each starting with the 0x47 sync byte
+TS_PACKET = 188
+TS_SYNCS = 5
+
+Kind = Literal["video", "audio", "image", "archive", "other", "reject"]
+
+
+@dataclasses.dataclass(frozen=True)
+class Sniffed:
+    kind: Kind
+    ext: Optional[str] = None
+
+
+def _is_tar(head: bytes) -> bool:
+    return head[257:262] == b"ustar"
+
+
+def _compressed_tar(head: bytes, decompressor) -> bool:
+    """Checks whether the decompressible prefix of head is a tar header"""
+    try:
+        return _is_tar(decompressor.decompress(head))
+    except (OSError, EOFError, ValueError, zlib.error, lzma.LZMAError):
+        return False
+
+
+def _is_ts(head: bytes) -> bool:
+    """Checks for sync bytes at the start of the first few packets, one is a coincidence"""
+    syncs = min(TS_SYNCS, len(head) // TS_PACKET)
+    return syncs >= 3 and all(head[i * TS_PACKET] == 0x47 for i in range(syncs))
+
+
+def sniff(head: bytes) -> Sniffed:
+    """Identifies a file from its first bytes, unrecognised binaries are "other" """
+    if not head:
+        return Sniffed("reject")
+    # ISO base media: mp4, mov, m4a, 3gp, heic, avif
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand == b"qt  ":
+            return Sniffed("video", ".mov")
+        if brand in (b"M4A ", b"M4B ", b"M4P "):
+            return Sniffed("audio", ".m4a")
+        if brand in (b"avif", b"avis"):
+            return Sniffed("image", ".avif")
+        if brand in (b"heic", b"heix", b"mif1", b"msf1"):
+            return Sniffed("image", ".heic")
+        if brand.startswith(b"3g"):
+            return Sniffed("video", ".3gp")
+        return Sniffed("video", ".mp4")
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return Sniffed("video", ".webm" if b"webm" in head[:64] else ".mkv")
+    if head.startswith(b"RIFF"):
+        fourcc = head[8:12]
+        if fourcc == b"AVI ":
+            return Sniffed("video", ".avi")
+        if fourcc == b"WEBP":
+            return Sniffed("image", ".webp")
+        if fourcc == b"WAVE":
+            return Sniffed("audio", ".wav")
+    if head.startswith(b"FLV\x01"):
+        return Sniffed("video", ".flv")
+    if head.startswith(b"\x00\x00\x01\xba"):
+        return Sniffed("video", ".mpg")
+    if head.startswith(b"\x30\x26\xb2\x75\x8e\x66\xcf\x11"):
+        return Sniffed("video", ".wmv")
+
+    if head.startswith(b"\xff\xd8\xff"):
+        return Sniffed("image", ".jpg")
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return Sniffed("image", ".png")
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return Sniffed("image", ".gif")
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return Sniffed("image", ".tiff")
+    if head.startswith(b"BM") and head[6:10] == b"\x00\x00\x00\x00":
+        return Sniffed("image", ".bmp")
+
+    # MPEG audio frame sync, 11 set bits
+    if head.startswith(b"ID3") or (
+        len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0
+    ):
+        return Sniffed("audio", ".mp3")
+    if head.startswith(b"OggS"):
+        return Sniffed("audio", ".ogg")
+    if head.startswith(b"fLaC"):
+        return Sniffed("audio", ".flac")
+
+    # Only formats shutil.unpack_archive understands count as archives
+    if head.startswith((b"PK\x03\x04", b"PK\x05\x06")):
+        return Sniffed("archive", ".zip")
+    if _is_tar(head):
+        return Sniffed("archive", ".tar")
+    if head.startswith(b"\x1f\x8b"):
+        if _compressed_tar(head, zlib.decompressobj(16 + zlib.MAX_WBITS)):
+            return Sniffed("archive", ".tar.gz")
+        return Sniffed("other", ".gz")
+    if head.startswith(b"BZh"):
+        if _compressed_tar(head, bz2.BZ2Decompressor()):
+            return Sniffed("archive", ".tar.bz2")
+        return Sniffed("other", ".bz2")
+    if head.startswith(b"\xfd7zXZ\x00"):
+        if _compressed_tar(head, lzma.LZMADecompressor()):
+            return Sniffed("archive", ".tar.xz")
+        return Sniffed("other", ".xz")
+    if head.startswith(b"Rar!\x1a\x07"):
+        return Sniffed("other", ".rar")
+    if head.startswith(b"7z\xbc\xaf\x27\x1c"):
+        return Sniffed("other", ".7z")
+    if head.startswith(b"%PDF-"):
+        return Sniffed("other", ".pdf")
+
+    # No magic of its own, so only after every format that has one
+    if _is_ts(head):
+        return Sniffed("video", ".ts")
+
+    # Error and login pages served in place of the media
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if text.startswith((b"<!doctype", b"<html", b"<?xml", b"<head", b"{", b"[")):
+        return Sniffed("reject")
+    if text.startswith(b"#extm3u"):
+        return Sniffed("other", ".m3u8")
+    return Sniffed("other")
+
+
+def sniff_file(file: Path) -> Sniffed:
+    with open(file, "rb") as f:
+        return sniff(f.read(SNIFF_SIZE))
+
+
+def retype(file: Path) -> Tuple[Path, Sniffed]:
+    """Renames file to the extension of its sniffed type, returns the new path"""
+    sniffed = sniff_file(file)
+    if sniffed.ext is None or file.name.lower().endswith(sniffed.ext):
+        return file, sniffed
+    target = file.with_suffix(sniffed.ext)
+    if target.exists():
+        return file, sniffed
+    file.rename(target)
+    return target, sniffed
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from typing import List
+
+from mediamagic.services.filesizelimit import FileSizeLimits
+
+
+class StandIn:
+    """Local stand-in for a guild, accepts messages up to limit Mb"""
+
+    def __init__(self, reported: int, limit: int, tier: int = 0) -> None:
+        self.guild = SimpleNamespace(
+            id=1, filesize_limit=reported * 1024**2, premium_tier=tier
+        )
+        self.limit = limit
+        self.probes: List[int] = []
+
+    async def probe(self, size: int) -> bool:
+        self.probes.append(size)
+        return size <= self.limit * 1024**2
+
+
+class TestFileSizeLimits(unittest.TestCase):
+    def test_reported_limit_is_confirmed(self) -> None:
+        stand_in = StandIn(reported=25, limit=25)
+        limits = FileSizeLimits()
+        self.assertEqual(
+            asyncio.run(limits.resolve(stand_in.guild, stand_in.probe)), 25
+        )
+        self.assertEqual(len(stand_in.probes), 1)
+        self.assertGreater(stand_in.probes[0], 10 * 1024**2)
+
+    def test_boosted_guilds_are_not_probed(self) -> None:
+        for tier, reported in ((2, 50), (3, 100)):
+            stand_in = StandIn(reported=reported, limit=reported, tier=tier)
+            limits = FileSizeLimits()
+            self.assertEqual(
+                asyncio.run(limits.resolve(stand_in.guild, stand_in.probe)), reported
+            )
+            self.assertEqual(stand_in.probes, [])
+
+    def test_steps_down_to_the_enforced_limit(self) -> None:
+        # Guilds below tier 2 report 25 Mb but refuse attachments over 10
+        stand_in = StandIn(reported=25, limit=10)
+        limits = FileSizeLimits()
+        self.assertEqual(
+            asyncio.run(limits.resolve(stand_in.guild, stand_in.probe)), 10
+        )
+        self.assertEqual(limits.limit(stand_in.guild), 10)
+
+    def test_probes_once_per_guild(self) -> None:
+        stand_in = StandIn(reported=25, limit=10)
+        limits = FileSizeLimits()
+
+        async def _resolve_all() -> List[int]:
+            return await asyncio.gather(
+                *(limits.resolve(stand_in.guild, stand_in.probe) for _ in range(5))
+            )
+
+        self.assertEqual(asyncio.run(_resolve_all()), [10] * 5)
+        self.assertEqual(len(stand_in.probes), 1)
+
+    def test_failed_probe_is_not_repeated(self) -> None:
+        stand_in = StandIn(reported=25, limit=10)
+        limits = FileSizeLimits()
+
+        async def _broken(size: int) -> bool:
+            raise ConnectionError
+
+        self.assertEqual(asyncio.run(limits.resolve(stand_in.guild, _broken)), 25)
+        self.assertEqual(
+            asyncio.run(limits.resolve(stand_in.guild, stand_in.probe)), 25
+        )
+        self.assertEqual(stand_in.probes, [])
+        # A refused upload still lowers the limit
+        limits.refused(stand_in.guild.id, 20 * 1024**2)
+        self.assertEqual(limits.limit(stand_in.guild), 10)
+
+    def test_never_steps_up(self) -> None:
+        stand_in = StandIn(reported=25, limit=10)
+        limits = FileSizeLimits()
+        asyncio.run(limits.resolve(stand_in.guild, stand_in.probe))
+        limits.accepted(stand_in.guild.id, 20 * 1024**2)
+        limits.refused(stand_in.guild.id, 5 * 1024**2)
+        self.assertEqual(limits.limit(stand_in.guild), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from typing import List
+
+import httpx
+
+from mediamagic.services.adownloader import Adownloader
+
+URL = "http://media.test/video.mp4"
+BODY = b"\x00\x00\x00\x18ftypisom" + os.urandom(256 * 1024)
+
+
+class StandIn:
+    """Local stand-in for a media server, optionally ignoring Range headers"""
+
+    def __init__(self, honour_ranges: bool = True) -> None:
+        self.honour_ranges = honour_ranges
+        self.gets: List[str] = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        headers = {"Accept-Ranges": "bytes", "Content-Type": "video/mp4"}
+        if request.method == "HEAD":
+            return httpx.Response(
+                200, headers={**headers, "Content-Length": str(len(BODY))}
+            )
+        self.gets.append(request.headers.get("Range", ""))
+        if self.honour_ranges and (value := request.headers.get("Range")):
+            first, last = value.removeprefix("bytes=").split("-")
+            end = min(int(last), len(BODY) - 1)
+            headers["Content-Range"] = f"bytes {first}-{end}/{len(BODY)}"
+            return httpx.Response(
+                206, headers=headers, content=BODY[int(first) : end + 1]
+            )
+        return httpx.Response(200, headers=headers, content=BODY)
+
+    def download(self, dir: Path, threshold: int = 64 * 1024) -> List[Path]:
+        async def _download() -> List[Path]:
+            async with httpx.AsyncClient(
+                transport=httpx.MockTransport(self.handle)
+            ) as client:
+                downloader = Adownloader(
+                    {URL},
+                    connections=4,
+                    segment_threshold=threshold,
+                    single_flight=None,
+                    client=client,
+                )
+                await downloader.download(dir)
+            return list(dir.iterdir())
+
+        return asyncio.run(_download())
+
+
+class TestSegmentedDownload(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self) -> None:
+        for file in self.dir.iterdir():
+            file.unlink()
+        self.dir.rmdir()
+
+    def test_fetches_ranges_in_parallel(self) -> None:
+        server = StandIn()
+        files = server.download(self.dir)
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0].read_bytes(), BODY)
+        self.assertEqual(len(server.gets), 4)
+        self.assertTrue(all(x.startswith("bytes=") for x in server.gets))
+
+    def test_server_ignoring_ranges_falls_back_to_one_stream(self) -> None:
+        server = StandIn(honour_ranges=False)
+        files = server.download(self.dir)
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0].read_bytes(), BODY)
+        # The whole body comes in a single plain request after the ranges failed
+        self.assertEqual(server.gets[-1], "")
+
+    def test_small_files_take_one_request(self) -> None:
+        server = StandIn()
+        files = server.download(self.dir, threshold=len(BODY) + 1)
+        self.assertEqual(files[0].read_bytes(), BODY)
+        self.assertEqual(server.gets, [""])
+
+
+if __name__ == "__main__":
+    unittest.main()